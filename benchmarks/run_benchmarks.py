@@ -0,0 +1,227 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..', 'source'))
+
+import lcd
+import synthetic
+import download
+import ingest
+import prepare
+import process
+import evaluate
+
+DAILY_AVG_FIELDS = ['DailyAverageDryBulbTemperature',
+                    'DailyMaximumDryBulbTemperature',
+                    'DailyMinimumDryBulbTemperature',
+                    'DailyAverageSeaLevelPressure',
+                    'DailyAverageStationPressure']
+MONTHLY_AVG_FIELDS = ['MonthlyMeanTemperature',
+                      'MonthlyMaximumTemperature',
+                      'MonthlyMinimumTemperature',
+                      'MonthlySeaLevelPressure',
+                      'MonthlyStationPressure']
+
+def measure(function, *args):
+    """
+    Runs a function once, measuring its wall time and the peak memory it allocates.
+
+    Peak memory is traced with tracemalloc, which also covers NumPy arrays. Tracing slows
+    down allocation heavy code, but equally so on every commit.
+
+    Args:
+        function (callable): Function to run.
+        *args: Arguments of the function.
+
+    Returns:
+        tuple: The result of the function, the wall time in seconds and the peak memory in MB.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, peak / 2 ** 20
+
+def git_commit():
+    """
+    Returns the current commit of the repository, marked with '+' if the tree has local changes.
+
+    Returns:
+        str or None: Short commit hash, None outside of a git checkout.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARKS_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=BENCHMARKS_DIR,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + '+' if dirty else commit
+
+def dataset(n_stations, hours_per_day, seed, year, data_root):
+    """
+    Returns the folder of a synthetic dataset, generating it on first use.
+
+    Args:
+        n_stations (int): Number of stations.
+        hours_per_day (int): Number of hourly rows per day.
+        seed (int): Seed of the dataset.
+        year (int): Year of the stations.
+        data_root (str): Folder holding the generated datasets.
+
+    Returns:
+        str: Root folder of the dataset, to be served by the stand-in server.
+    """
+    root = os.path.join(data_root, 'stations{}_hours{}_seed{}_year{}'.format(n_stations, hours_per_day, seed, year))
+    if not os.path.isfile(os.path.join(root, 'complete')):
+        shutil.rmtree(root, ignore_errors=True)
+        print("Generating", n_stations, "synthetic stations......")
+        synthetic.generate_stations(root, n_stations, year, seed, hours_per_day)
+        open(os.path.join(root, 'complete'), 'w').close()
+    return root
+
+def run_suite(n_stations, hours_per_day=24, seed=0, year=2023, workers=8, data_root=None):
+    """
+    Times every stage of the pipeline on a synthetic dataset served by the local stand-in server.
+
+    Args:
+        n_stations (int): Number of stations in the listing.
+        hours_per_day (int, optional): Number of hourly rows per day of each station.
+        seed (int, optional): Seed of the dataset and of the download sampling.
+        year (int, optional): Year of the stations.
+        workers (int, optional): Number of concurrent downloads.
+        data_root (str, optional): Folder holding the generated datasets.
+
+    Returns:
+        list of dict: One record per benchmark, with its time, peak memory and throughput.
+    """
+    root = dataset(n_stations, hours_per_day, seed, year, data_root or os.path.join(BENCHMARKS_DIR, '.data'))
+    station_dir = os.path.join(root, 'access', str(year))
+    station_paths = [os.path.join(station_dir, file_name) for file_name in sorted(os.listdir(station_dir))]
+    station_bytes = sum(os.path.getsize(path) for path in station_paths)
+    work_dir = tempfile.mkdtemp(prefix='lcd_benchmark_')
+    server, base_url = synthetic.serve(root)
+    records = []
+
+    def record(name, seconds, peak_mb, items, n_bytes=None):
+        records.append({'benchmark': name, 'stations': n_stations, 'hours_per_day': hours_per_day,
+                        'seconds': round(seconds, 4), 'peak_mb': round(peak_mb, 2), 'items': items,
+                        'items_per_second': round(items / seconds, 2),
+                        'mb_per_second': round(n_bytes / 2 ** 20 / seconds, 2) if n_bytes else None})
+
+    try:
+        # Download a quarter as many stations as are listed, with a cold cache
+        n_locs = max(1, n_stations // 4)
+        data_dir = os.path.join(work_dir, 'data')
+        _, seconds, peak_mb = measure(download.download_csv, base_url, year, n_locs, seed, workers, data_dir,
+                                      os.path.join(work_dir, 'cache'))
+        cache_bytes = sum(os.path.getsize(os.path.join(folder, file_name))
+                          for folder, _, file_names in os.walk(os.path.join(work_dir, 'cache', str(year)))
+                          for file_name in file_names)
+        record('download_csv', seconds, peak_mb, n_locs, cache_bytes)
+
+        # Check the validity of every station
+        def check_all():
+            return [download.is_valid_file(path, DAILY_AVG_FIELDS, MONTHLY_AVG_FIELDS) for path in station_paths]
+        _, seconds, peak_mb = measure(check_all)
+        record('is_valid_file', seconds, peak_mb, n_stations, station_bytes)
+
+        # The remaining stages run on all stations, valid or not. The hourly sources of the daily
+        # fields are ingested too, so stations without daily summaries are resampled as in ingest.py
+        intermediate_dir = os.path.join(work_dir, 'intermediate')
+        _, seconds, peak_mb = measure(ingest.ingest_folder, station_dir, intermediate_dir,
+                                      DAILY_AVG_FIELDS + MONTHLY_AVG_FIELDS + lcd.hourly_fields(DAILY_AVG_FIELDS))
+        record('ingest_folder', seconds, peak_mb, n_stations, station_bytes)
+
+        (gt_averages, locations), seconds, peak_mb = measure(prepare.extract_monthly_averages, intermediate_dir,
+                                                             MONTHLY_AVG_FIELDS)
+        record('prepare.extract_monthly_averages', seconds, peak_mb, n_stations)
+        (est_averages, _), seconds, peak_mb = measure(process.extract_monthly_averages, intermediate_dir,
+                                                      DAILY_AVG_FIELDS)
+        record('process.extract_monthly_averages', seconds, peak_mb, n_stations)
+
+        gt_file = os.path.join(work_dir, 'prepare_output.csv')
+        est_file = os.path.join(work_dir, 'process_output.csv')
+        _, seconds, peak_mb = measure(prepare.create_csv_from_dict, gt_averages, locations, gt_file)
+        record('prepare.create_csv_from_dict', seconds, peak_mb, n_stations, os.path.getsize(gt_file))
+        _, seconds, peak_mb = measure(process.create_csv_from_dict, est_averages, locations, est_file)
+        record('process.create_csv_from_dict', seconds, peak_mb, n_stations, os.path.getsize(est_file))
+
+        _, seconds, peak_mb = measure(evaluate.compute_r2, gt_file, est_file)
+        record('compute_r2', seconds, peak_mb, n_stations, os.path.getsize(gt_file) + os.path.getsize(est_file))
+    finally:
+        server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return records
+
+def load_results(results_file):
+    """
+    Loads the stored benchmark results.
+
+    Args:
+        results_file (str): Path to the JSON lines file of results.
+
+    Returns:
+        list of dict: The stored records, oldest first.
+    """
+    if not os.path.isfile(results_file):
+        return []
+    with open(results_file, 'r') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+def report(records, history):
+    """
+    Prints the results next to the latest stored result of the same benchmark from another commit.
+
+    Args:
+        records (list of dict): Results of this run.
+        history (list of dict): Stored results of earlier runs.
+    """
+    print("{:<36}{:>9}{:>11}{:>10}{:>12}{:>10}".format('benchmark', 'stations', 'seconds', 'peak MB', 'items/s',
+                                                      'vs prev'))
+    for record in records:
+        previous = [old for old in history if old['benchmark'] == record['benchmark']
+                    and old['stations'] == record['stations'] and old['hours_per_day'] == record['hours_per_day']
+                    and old['commit'] != record['commit']]
+        ratio = '{:.2f}x'.format(record['seconds'] / previous[-1]['seconds']) if previous else '-'
+        print("{:<36}{:>9}{:>11.3f}{:>10.1f}{:>12.1f}{:>10}".format(record['benchmark'], record['stations'],
+                                                                  record['seconds'], record['peak_mb'],
+                                                                  record['items_per_second'], ratio))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic LCD data.")
+    parser.add_argument('--stations', type=int, nargs='+', default=[10, 100, 1000],
+                        help="numbers of stations to benchmark")
+    parser.add_argument('--hours-per-day', type=int, default=24, help="hourly rows per day of each station")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the synthetic data")
+    parser.add_argument('--workers', type=int, default=8, help="number of concurrent downloads")
+    parser.add_argument('--results', default=os.path.join(BENCHMARKS_DIR, 'results.jsonl'),
+                        help="JSON lines file to append the results to")
+    parser.add_argument('--no-save', action='store_true', help="only print the results")
+    args = parser.parse_args()
+
+    history = load_results(args.results)
+    run = {'commit': git_commit(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'python': platform.python_version(), 'machine': platform.machine(), 'cpus': os.cpu_count()}
+    records = []
+    for n_stations in args.stations:
+        records += [dict(run, **record) for record in run_suite(n_stations, args.hours_per_day, args.seed,
+                                                                workers=args.workers)]
+    report(records, history)
+
+    # Append the results, so that regressions show up across commits
+    if not args.no_save:
+        with open(args.results, 'a') as file:
+            for record in records:
+                file.write(json.dumps(record) + '\n')
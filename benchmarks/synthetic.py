@@ -0,0 +1,287 @@
+import io
+import os
+import csv
+import time
+import hashlib
+import functools
+import threading
+import http.server
+import numpy as np
+
+HOURLY_FIELDS = ['HourlyAltimeterSetting', 'HourlyDewPointTemperature', 'HourlyDryBulbTemperature',
+                 'HourlyPrecipitation', 'HourlyPresentWeatherType', 'HourlyRelativeHumidity',
+                 'HourlySeaLevelPressure', 'HourlyStationPressure', 'HourlyVisibility', 'HourlyWindSpeed']
+DAILY_FIELDS = ['DailyAverageDryBulbTemperature', 'DailyMaximumDryBulbTemperature', 'DailyMinimumDryBulbTemperature',
+                'DailyAverageSeaLevelPressure', 'DailyAverageStationPressure', 'DailyPrecipitation']
+MONTHLY_FIELDS = ['MonthlyMeanTemperature', 'MonthlyMaximumTemperature', 'MonthlyMinimumTemperature',
+                  'MonthlySeaLevelPressure', 'MonthlyStationPressure', 'MonthlyTotalLiquidPrecipitation']
+COLUMNS = (['STATION', 'DATE', 'LATITUDE', 'LONGITUDE', 'ELEVATION', 'NAME', 'REPORT_TYPE', 'SOURCE']
+           + HOURLY_FIELDS + DAILY_FIELDS + MONTHLY_FIELDS + ['REM'])
+
+# Share of stations with daily and monthly summaries for each station id prefix (network).
+# US stations (72, 74) mostly carry summaries, buoys and ships (99) hardly ever do.
+NETWORK_VALIDITY = {'72': 0.9, '74': 0.7, '01': 0.5, '99': 0.05}
+
+def format_values(numbers, digits, rng, suspect_rate, missing_rate):
+    """
+    Formats an array of numbers as LCD values, leaving some empty and flagging some as suspect.
+
+    Args:
+        numbers (numpy.ndarray): Numbers to format.
+        digits (int): Number of decimals.
+        rng (numpy.random.Generator): Random generator of the station.
+        suspect_rate (float): Share of values suffixed with 's' (suspect).
+        missing_rate (float): Share of empty values.
+
+    Returns:
+        numpy.ndarray: The formatted values.
+    """
+    texts = np.char.mod('%.{}f'.format(digits), numbers)
+    draws = rng.random(numbers.shape)
+    texts = np.where(draws > 1 - suspect_rate, np.char.add(texts, 's'), texts)
+    return np.where(draws < missing_rate, '', texts)
+
+def station_rows(station, year, rng, hours_per_day, has_daily, has_monthly, suspect_rate, missing_rate):
+    """
+    Generates the rows of a station in LCD format.
+
+    Every day has hours_per_day hourly (FM-15) rows and, if has_daily, a summary of day
+    (SOD) row. The last day of every month has a summary of month (SOM) row if has_monthly.
+    Values are suffixed with 's' (suspect) at suspect_rate and left empty at missing_rate.
+
+    Args:
+        station (str): Station id.
+        year (int): Year of the rows.
+        rng (numpy.random.Generator): Random generator of the station.
+        hours_per_day (int): Number of hourly rows per day.
+        has_daily (bool): Whether the daily summary fields have values.
+        has_monthly (bool): Whether the monthly summary fields have values.
+        suspect_rate (float): Share of values flagged as suspect.
+        missing_rate (float): Share of empty values.
+
+    Yields:
+        list of str: Values of a row, one per column of COLUMNS.
+    """
+    head = ['{:.4f}'.format(rng.uniform(-60, 70)), '{:.4f}'.format(rng.uniform(-180, 180)),
+            '{:.1f}'.format(rng.uniform(0, 2000)), 'STATION {}, XX US'.format(station)]
+    days = np.arange('{}-01-01'.format(year), '{}-01-01'.format(year + 1), dtype='datetime64[D]')
+    shape = (len(days), hours_per_day)
+
+    # Hourly observations following the season and the time of day
+    season = rng.uniform(30, 70) - 20 * np.cos(2 * np.pi * (np.arange(len(days)) - 14) / 365)
+    temperatures = (season[:, None] + 10 * np.sin(np.linspace(0, 2 * np.pi, hours_per_day))[None, :]
+                    + rng.normal(0, 3, shape))
+    pressures = rng.normal(29.9, 0.2, shape)
+    minutes = (np.arange(hours_per_day) * 24 * 60) // hours_per_day + 53 * (hours_per_day == 24)
+    times = np.datetime_as_string(days[:, None] + minutes[None, :].astype('timedelta64[m]'), unit='s')
+    hourly = [format_values(pressures + 0.1, 2, rng, suspect_rate, missing_rate),
+              format_values(temperatures - 10, 0, rng, suspect_rate, missing_rate),
+              format_values(temperatures, 0, rng, suspect_rate, missing_rate),
+              rng.choice(['0.00', 'T', '0.01', ''], shape),
+              rng.choice(['', '', 'RA:02 |RA |', 'BR:1 ||'], shape),
+              format_values(rng.uniform(30, 100, shape), 0, rng, suspect_rate, missing_rate),
+              format_values(pressures, 2, rng, suspect_rate, missing_rate),
+              format_values(pressures - 0.9, 2, rng, suspect_rate, missing_rate),
+              format_values(rng.uniform(1, 10, shape), 2, rng, suspect_rate, missing_rate),
+              format_values(rng.uniform(0, 20, shape), 0, rng, suspect_rate, missing_rate)]
+    hourly = np.stack(hourly, axis=-1).tolist()
+    times = times.tolist()
+
+    # Daily and monthly summaries
+    daily = np.stack([format_values(temperatures.mean(axis=1), 0, rng, suspect_rate, missing_rate),
+                      format_values(temperatures.max(axis=1), 0, rng, suspect_rate, missing_rate),
+                      format_values(temperatures.min(axis=1), 0, rng, suspect_rate, missing_rate),
+                      format_values(pressures.mean(axis=1), 2, rng, suspect_rate, missing_rate),
+                      format_values(pressures.mean(axis=1) - 0.9, 2, rng, suspect_rate, missing_rate),
+                      rng.choice(['T', '0.10', '0.00'], len(days))], axis=-1).tolist()
+    monthly = np.stack([format_values(season + offset, digits, rng, suspect_rate, missing_rate)
+                        for offset, digits in ((0, 1), (12, 1), (-12, 1))]
+                       + [format_values(rng.normal(29.9, 0.1, len(days)), 2, rng, suspect_rate, missing_rate),
+                          format_values(rng.normal(29.0, 0.1, len(days)), 2, rng, suspect_rate, missing_rate),
+                          format_values(rng.uniform(0, 5, len(days)), 2, rng, suspect_rate, missing_rate)],
+                       axis=-1).tolist()
+    month_ends = days.astype('datetime64[M]') != (days + 1).astype('datetime64[M]')
+
+    empty_summaries = [''] * (len(DAILY_FIELDS) + len(MONTHLY_FIELDS))
+    for day in range(len(days)):
+        for hour in range(hours_per_day):
+            yield [station, times[day][hour]] + head + ['FM-15', '7'] + hourly[day][hour] + empty_summaries + ['MET10,1 2 ,3']
+        summary = [station, str(days[day]) + 'T23:59:00'] + head
+        if has_daily:
+            yield (summary + ['SOD  ', '7'] + [''] * len(HOURLY_FIELDS) + daily[day]
+                   + [''] * len(MONTHLY_FIELDS) + [''])
+        if has_monthly and month_ends[day]:
+            yield summary + ['SOM  ', '7'] + [''] * (len(HOURLY_FIELDS) + len(DAILY_FIELDS)) + monthly[day] + ['']
+
+def write_station(file_path, station, year, seed, hours_per_day=24, has_daily=True, has_monthly=True,
+                  suspect_rate=0.05, missing_rate=0.1):
+    """
+    Writes a synthetic LCD CSV file for a station, quoting every value as NOAA does.
+
+    Args:
+        file_path (str): Path of the CSV file to write.
+        station (str): Station id.
+        year (int): Year of the rows.
+        seed (int): Seed of the station's random generator.
+        hours_per_day (int, optional): Number of hourly rows per day.
+        has_daily (bool, optional): Whether the daily summary fields have values.
+        has_monthly (bool, optional): Whether the monthly summary fields have values.
+        suspect_rate (float, optional): Share of values flagged as suspect.
+        missing_rate (float, optional): Share of empty values.
+    """
+    rng = np.random.default_rng(seed)
+    with open(file_path, 'w', newline='') as file:
+        writer = csv.writer(file, quoting=csv.QUOTE_ALL)
+        writer.writerow(COLUMNS)
+        writer.writerows(station_rows(station, year, rng, hours_per_day, has_daily, has_monthly,
+                                      suspect_rate, missing_rate))
+
+def generate_stations(root, n_stations, year=2023, seed=0, hours_per_day=24, validity=NETWORK_VALIDITY,
+                      suspect_rate=0.05, missing_rate=0.1):
+    """
+    Generates a deterministic set of synthetic stations under root/access/<year>/, as laid out on the NOAA server.
+
+    Station ids are spread over the networks of validity. Each station carries daily and
+    monthly summaries with the probability of its network, and otherwise lacks the daily
+    summaries, the monthly summaries or both.
+
+    Args:
+        root (str): Root folder of the stand-in server.
+        n_stations (int): Number of stations.
+        year (int, optional): Year of the stations.
+        seed (int, optional): Seed of the whole set.
+        hours_per_day (int, optional): Number of hourly rows per day, which sets the file size.
+        validity (dict, optional): Share of valid stations for each station id prefix.
+        suspect_rate (float, optional): Share of values flagged as suspect.
+        missing_rate (float, optional): Share of empty values.
+
+    Returns:
+        list of str: Names of the generated files.
+    """
+    if not isinstance(n_stations, int) or n_stations <= 0:
+        raise ValueError("n_stations must be a positive integer.")
+
+    folder = os.path.join(root, 'access', str(year))
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    prefixes = sorted(validity)
+    file_names = []
+    for i in range(n_stations):
+        prefix = prefixes[rng.integers(len(prefixes))]
+        station = '{}{:04d}{:05d}'.format(prefix, i, rng.integers(10000, 99999))
+        valid = rng.random() < validity[prefix]
+        lacks = rng.integers(3)  # Which summaries an invalid station lacks
+        file_name = station + '.csv'
+        write_station(os.path.join(folder, file_name), station, year, int(rng.integers(2 ** 32)), hours_per_day,
+                      valid or lacks == 1, valid or lacks == 0, suspect_rate, missing_rate)
+        file_names.append(file_name)
+    return file_names
+
+def human_size(size):
+    """
+    Formats a file size as the Apache directory listings on the NOAA server do.
+
+    Args:
+        size (int): Size in bytes.
+
+    Returns:
+        str: Size such as 812, 27K or 4.9M.
+    """
+    for unit in ('', 'K', 'M', 'G'):
+        if size < 1024 or unit == 'G':
+            break
+        size /= 1024
+    if unit == '':
+        return str(int(size))
+    return '{:.1f}{}'.format(size, unit) if size < 9.95 else '{:.0f}{}'.format(size, unit)
+
+def render_listing(folder):
+    """
+    Renders the listing of a folder in the format of the NOAA server.
+
+    Args:
+        folder (str): Folder to list.
+
+    Returns:
+        str: HTML of the listing.
+    """
+    lines = ['<html><head><title>Index of {}</title></head><body>'.format(folder), '<table>']
+    for file_name in sorted(os.listdir(folder)):
+        stat = os.stat(os.path.join(folder, file_name))
+        modified = time.strftime('%Y-%m-%d %H:%M', time.gmtime(stat.st_mtime))
+        lines.append('<tr><td valign="top"><img src="/icons/unknown.gif" alt="[   ]"></td>'
+                     '<td><a href="{0}">{0}</a></td><td align="right">{1}  </td><td align="right">{2}</td>'
+                     '<td>&nbsp;</td></tr>'.format(file_name, modified, human_size(stat.st_size)))
+    lines += ['</table>', '</body></html>', '']
+    return '\n'.join(lines)
+
+class StandInHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Serves the stations under a root folder like the NOAA server: Apache style listings
+    with ETag and Last-Modified validators, and station files with Range support. A Range
+    request whose If-Range does not match the Last-Modified time of the file gets the whole
+    file.
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            return self.send_listing(path)
+        if not os.path.isfile(path) or 'Range' not in self.headers:
+            return super().send_head()
+        last_modified = self.date_time_string(os.stat(path).st_mtime)
+        if self.headers.get('If-Range', last_modified) != last_modified:
+            return super().send_head()
+
+        # Serve the requested tail of the file
+        start = int(self.headers['Range'].split('=')[1].split('-')[0])
+        file = open(path, 'rb')
+        size = os.fstat(file.fileno()).st_size
+        if start >= size:
+            file.close()
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */{}'.format(size))
+            self.end_headers()
+            return None
+        file.seek(start)
+        self.send_response(206)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, size - 1, size))
+        self.send_header('Content-Length', str(size - start))
+        self.send_header('Last-Modified', last_modified)
+        self.end_headers()
+        return file
+
+    def send_listing(self, folder):
+        body = render_listing(folder).encode()
+        etag = '"{}"'.format(hashlib.sha256(body).hexdigest()[:16])
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return None
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(os.stat(folder).st_mtime))
+        self.end_headers()
+        return io.BytesIO(body)
+
+def serve(root, port=0):
+    """
+    Starts the local stand-in of the NOAA server in a background thread.
+
+    Args:
+        root (str): Root folder holding access/<year>/ with the station files.
+        port (int, optional): Port to listen on, 0 for a free one.
+
+    Returns:
+        tuple: The server, to be stopped with shutdown(), and its base URL.
+    """
+    handler = functools.partial(StandInHandler, directory=root)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}/'.format(server.server_address[1])
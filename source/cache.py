@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+def open_cache(cache_dir):
+    """
+    Opens the station cache index, creating the cache directory and tables if needed.
+
+    Args:
+        cache_dir (str): Directory holding the cached station files and index.
+
+    Returns:
+        sqlite3.Connection: Connection to the cache index.
+    """
+    if not isinstance(cache_dir, str) or not cache_dir:
+        raise ValueError("Invalid cache_dir provided.")
+
+    os.makedirs(cache_dir, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(cache_dir, 'index.sqlite'))
+    # One row per (year, file name) holding the validity verdict of the file
+    conn.execute("""CREATE TABLE IF NOT EXISTS stations (
+                        year INTEGER NOT NULL,
+                        file_name TEXT NOT NULL,
+                        valid INTEGER NOT NULL,
+                        fields_seen TEXT NOT NULL,
+                        size INTEGER,
+                        sha256 TEXT,
+                        fetched_at REAL NOT NULL,
+                        criteria TEXT,
+                        listed_size INTEGER,
+                        listed_modified TEXT,
+                        PRIMARY KEY (year, file_name))""")
+    # Indexes written before verdicts recorded their validation criteria and catalog entry lack the columns
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(stations)")]
+    for column, column_type in (('criteria', 'TEXT'), ('listed_size', 'INTEGER'), ('listed_modified', 'TEXT')):
+        if column not in columns:
+            conn.execute("ALTER TABLE stations ADD COLUMN {} {}".format(column, column_type))
+    # One row per year holding the validators of the cached station listing
+    conn.execute("""CREATE TABLE IF NOT EXISTS listings (
+                        year INTEGER PRIMARY KEY,
+                        etag TEXT,
+                        last_modified TEXT,
+                        fetched_at REAL NOT NULL)""")
+    # One row per station file of the listing, in listing order
+    conn.execute("""CREATE TABLE IF NOT EXISTS catalog (
+                        year INTEGER NOT NULL,
+                        position INTEGER NOT NULL,
+                        file_name TEXT NOT NULL,
+                        size INTEGER,
+                        modified TEXT,
+                        PRIMARY KEY (year, file_name))""")
+    conn.execute("CREATE INDEX IF NOT EXISTS catalog_size ON catalog (year, size)")
+    conn.commit()
+    return conn
+
+def cached_file_path(cache_dir, year, file_name):
+    """
+    Returns the path of a station file inside the cache.
+
+    Args:
+        cache_dir (str): Directory holding the cached station files and index.
+        year (int): Year of the station file.
+        file_name (str): Name of the station file.
+
+    Returns:
+        str: Path of the cached file.
+    """
+    return os.path.join(cache_dir, str(year), file_name)
+
+def file_checksum(file_path):
+    """
+    Computes the SHA-256 checksum of a file.
+
+    Args:
+        file_path (str): Path to the file.
+
+    Returns:
+        str: Hex digest of the file contents.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def criteria_key(daily_avg_fields, monthly_avg_fields, hourly_fallback):
+    """
+    Computes a key identifying the rule a validity verdict was reached with.
+
+    Args:
+        daily_avg_fields (list of str): Daily fields checked.
+        monthly_avg_fields (list of str): Monthly fields checked.
+        hourly_fallback (bool): Whether hourly observations could stand in for daily summaries.
+
+    Returns:
+        str: Hex digest of the criteria.
+    """
+    criteria = json.dumps([list(daily_avg_fields), list(monthly_avg_fields), bool(hourly_fallback)])
+    return hashlib.sha256(criteria.encode()).hexdigest()[:16]
+
+def get_verdicts(conn, year, criteria=None):
+    """
+    Reads the validity verdicts of all indexed station files of a year.
+
+    A verdict only holds for the version of the file it was reached on, so verdicts whose
+    recorded catalog entry (listed size and modification time) differs from the current
+    catalog are left out, and their files count as unknown.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the cache index.
+        year (int): Year of the station files.
+        criteria (str, optional): Only verdicts reached with these criteria (see criteria_key),
+            so that files judged under other criteria count as unknown. None for all verdicts.
+
+    Returns:
+        dict: Mapping from file name to a (valid, size, sha256) tuple.
+    """
+    query = ("SELECT s.file_name, s.valid, s.size, s.sha256 FROM stations s LEFT JOIN catalog c "
+             "ON c.year = s.year AND c.file_name = s.file_name "
+             "WHERE s.year = ? AND s.listed_size IS c.size AND s.listed_modified IS c.modified")
+    args = [year]
+    if criteria is not None:
+        query += " AND s.criteria = ?"
+        args.append(criteria)
+    return {file_name: (bool(valid), size, sha256) for file_name, valid, size, sha256 in conn.execute(query, args)}
+
+def record_verdict(conn, year, file_name, valid, fields_seen, size=None, sha256=None, criteria=None, listed=None):
+    """
+    Stores the validity verdict of a station file in the index.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the cache index.
+        year (int): Year of the station file.
+        file_name (str): Name of the station file.
+        valid (bool): Whether the file contains valid data.
+        fields_seen (iterable of str): Fields observed to be non-empty before the verdict was reached.
+        size (int, optional): Size of the cached file in bytes.
+        sha256 (str, optional): SHA-256 checksum of the cached file.
+        criteria (str, optional): Key of the criteria the verdict was reached with (see criteria_key).
+        listed (tuple, optional): (size, modified) of the file in the catalog when it was fetched.
+    """
+    listed_size, listed_modified = listed if listed is not None else (None, None)
+    conn.execute("INSERT OR REPLACE INTO stations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                 (year, file_name, int(valid), ','.join(sorted(fields_seen)), size, sha256, time.time(), criteria,
+                  listed_size, listed_modified))
+    conn.commit()
+
+def restore_file(cached_path, target_path, size, sha256):
+    """
+    Copies a cached station file to its target path, verifying its size and checksum.
+
+    Args:
+        cached_path (str): Path of the cached file.
+        target_path (str): Path to copy the file to.
+        size (int): Expected size of the file in bytes.
+        sha256 (str): Expected SHA-256 checksum of the file.
+
+    Returns:
+        bool: True if the file was restored, False if it is missing or corrupted.
+    """
+    if not os.path.isfile(cached_path) or os.path.getsize(cached_path) != size:
+        return False
+
+    # Copy and hash the file in a single pass
+    digest = hashlib.sha256()
+    with open(cached_path, 'rb') as source, open(target_path, 'wb') as target:
+        for block in iter(lambda: source.read(1 << 20), b''):
+            digest.update(block)
+            target.write(block)
+    if digest.hexdigest() != sha256:
+        os.remove(target_path)
+        return False
+    return True
@@ -0,0 +1,316 @@
+import os
+import re
+import json
+import math
+import time
+import yaml
+import random
+import requests
+import cache
+import fetch
+
+# Link to a station file, and the modification time and size columns which follow it in the listing
+LINK_PATTERN = re.compile(r'href="([^"/]+\.csv)"')
+MODIFIED_PATTERN = re.compile(r'(\d{4}-\d{2}-\d{2} \d{2}:\d{2})')
+SIZE_PATTERN = re.compile(r'(?<![\d:.-])(\d+(?:\.\d+)?)([KMGT]?)(?![\d:.-])')
+SIZE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+# Conditions on the recorded validity verdict of a station file
+VALIDITY_FILTERS = {'valid': "s.valid = 1", 'invalid': "s.valid = 0", 'unknown': "s.valid IS NULL"}
+
+# Leading characters of a station id which identify its network (the WMO block of the USAF id)
+PREFIX_LENGTH = 2
+# Weight of the overall validity rate when smoothing the rate of a prefix or size class
+PRIOR_WEIGHT = 5
+
+def parse_listing(html):
+    """
+    Parses the station files out of an HTML directory listing.
+
+    Args:
+        html (str): Contents of the listing.
+
+    Returns:
+        list of tuple: (file_name, size, modified) of each station file in listing order. The size
+        in bytes (approximate, as the listing rounds it) and the modification time are None when
+        the listing does not show them.
+    """
+    entries = []
+    for line in html.splitlines():
+        link = LINK_PATTERN.search(line)
+        if link is None:
+            continue
+        # Remove the tags so that only the link text and the columns after it remain
+        rest = re.sub(r'<[^>]*>', ' ', line[link.end():])
+        modified = MODIFIED_PATTERN.search(rest)
+        size = SIZE_PATTERN.search(rest, modified.end()) if modified is not None else None
+        entries.append((link.group(1),
+                        int(float(size.group(1)) * SIZE_UNITS[size.group(2)]) if size is not None else None,
+                        modified.group(1) if modified is not None else None))
+    return entries
+
+def refresh_catalog(conn, session, base_url, year, cache_dir, timeout=60):
+    """
+    Brings the station catalog of a year up to date with the listing on the server.
+
+    The listing is cached next to the station files and refetched with a conditional GET,
+    so an unchanged listing costs a single round trip and is not parsed again. If the server
+    cannot be reached, an existing catalog is kept as it is.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the cache index.
+        session (requests.Session): HTTP session to use.
+        base_url (str): Base URL for downloading files.
+        year (int): Year of the listing.
+        cache_dir (str): Directory holding the station cache.
+        timeout (float, optional): Connect and read timeout in seconds.
+
+    Returns:
+        bool: True if the catalog was rebuilt from a new listing, False if it was up to date.
+    """
+    listing_path = cache.cached_file_path(cache_dir, year, 'data_store.html')
+    os.makedirs(os.path.dirname(listing_path), exist_ok=True)
+
+    # Only send the validators if the listing they belong to is still on disk
+    row = conn.execute("SELECT etag, last_modified FROM listings WHERE year = ?", (year,)).fetchone()
+    etag, last_modified = row if row is not None and os.path.isfile(listing_path) else (None, None)
+    try:
+        validators = fetch.fetch_if_modified(session, "{}access/{}/".format(base_url, year), listing_path,
+                                             etag, last_modified, timeout)
+    except requests.RequestException as error:
+        if row is None:
+            raise
+        print("Failed to refresh the station listing, using the cached catalog:", error)
+        return False
+    if validators is None:
+        return False
+
+    # Replace the catalog of the year with the new listing
+    with open(listing_path, 'r') as page:
+        entries = parse_listing(page.read())
+    with conn:
+        conn.execute("DELETE FROM catalog WHERE year = ?", (year,))
+        conn.executemany("INSERT INTO catalog VALUES (?, ?, ?, ?, ?)",
+                         [(year, position, file_name, size, modified)
+                          for position, (file_name, size, modified) in enumerate(entries)])
+        conn.execute("INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)",
+                     (year, validators['etag'], validators['last_modified'], time.time()))
+    return True
+
+def sample_stations(conn, year, min_size=None, max_size=None, validity=None, criteria=None):
+    """
+    Looks up the station files of a year in the catalog, optionally filtered by size and validity.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the cache index.
+        year (int): Year of the station files.
+        min_size (int, optional): Minimum file size in bytes.
+        max_size (int, optional): Maximum file size in bytes.
+        validity (str, optional): Only files whose recorded verdict is 'valid', 'invalid' or
+            'unknown' (never checked), None for all files.
+        criteria (str, optional): Only count verdicts reached with these criteria (see
+            cache.criteria_key), other verdicts are unknown. Verdicts reached on another version
+            of a file (see cache.get_verdicts) are unknown as well.
+
+    Returns:
+        list of str: Names of the matching station files in listing order. Files of unknown
+        size are left out once a size bound is given.
+    """
+    if validity is not None and validity not in VALIDITY_FILTERS:
+        raise ValueError("validity must be one of {}.".format(sorted(VALIDITY_FILTERS)))
+
+    query = ("SELECT c.file_name FROM catalog c LEFT JOIN stations s ON s.year = c.year AND s.file_name = c.file_name "
+             "AND s.listed_size IS c.size AND s.listed_modified IS c.modified")
+    args = []
+    if criteria is not None:
+        query += " AND s.criteria = ?"
+        args.append(criteria)
+    query += " WHERE c.year = ?"
+    args.append(year)
+    if min_size is not None:
+        query += " AND c.size >= ?"
+        args.append(min_size)
+    if max_size is not None:
+        query += " AND c.size <= ?"
+        args.append(max_size)
+    if validity is not None:
+        query += " AND " + VALIDITY_FILTERS[validity]
+    return [file_name for file_name, in conn.execute(query + " ORDER BY c.position", args)]
+
+def listed_entries(conn, year):
+    """
+    Looks up the listed size and modification time of every station file of a year.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the cache index.
+        year (int): Year of the station files.
+
+    Returns:
+        dict: Mapping from file name to its (size, modified) in the catalog.
+    """
+    return {file_name: (size, modified) for file_name, size, modified
+            in conn.execute("SELECT file_name, size, modified FROM catalog WHERE year = ?", (year,))}
+
+def size_class(size):
+    """
+    Groups file sizes into classes which double in size.
+
+    Args:
+        size (int or None): Size of the file in bytes.
+
+    Returns:
+        int or None: Class of the size, None when the size is unknown.
+    """
+    return int(math.log2(size)) if size else None
+
+def validity_rates(conn, prefix_length=PREFIX_LENGTH, criteria=None, exclude_year=None):
+    """
+    Learns the validity rate of station files by station id prefix and by size class from the recorded verdicts.
+
+    The verdicts of all years count, since the networks which report summaries rarely change.
+    The verdicts of the year being sampled can be left out, so that checking its files does
+    not reorder its candidates on the next run.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the cache index.
+        prefix_length (int, optional): Number of leading characters of the station id forming the prefix.
+        criteria (str, optional): Only learn from verdicts reached with these criteria (see cache.criteria_key).
+        exclude_year (int, optional): Year whose verdicts are left out.
+
+    Returns:
+        dict: (valid, checked) counts of all files ('all') and for each prefix ('prefix') and size class ('size').
+    """
+    rates = {'all': [0, 0], 'prefix': {}, 'size': {}}
+    query = ("SELECT s.file_name, s.valid, COALESCE(c.size, s.size) FROM stations s LEFT JOIN catalog c "
+             "ON c.year = s.year AND c.file_name = s.file_name")
+    conditions, args = [], []
+    if criteria is not None:
+        conditions.append("s.criteria = ?")
+        args.append(criteria)
+    if exclude_year is not None:
+        conditions.append("s.year != ?")
+        args.append(exclude_year)
+    rows = conn.execute(query + "".join((" WHERE " if i == 0 else " AND ") + condition
+                                        for i, condition in enumerate(conditions)), args)
+    for file_name, valid, size in rows:
+        for counts in (rates['all'], rates['prefix'].setdefault(file_name[:prefix_length], [0, 0]),
+                       rates['size'].setdefault(size_class(size), [0, 0])):
+            counts[0] += valid
+            counts[1] += 1
+    return rates
+
+def save_rates(rates, file_path):
+    """
+    Writes validity counts to a JSON file, so that they can be tracked alongside the params.
+
+    Args:
+        rates (dict): Validity counts as returned by validity_rates.
+        file_path (str): Path of the JSON file to write.
+    """
+    # JSON keys are strings, the unknown size class None is written as "null"
+    data = {'all': rates['all'], 'prefix': rates['prefix'],
+            'size': {json.dumps(size): counts for size, counts in rates['size'].items()}}
+    with open(file_path, 'w') as file:
+        json.dump(data, file, indent=1, sort_keys=True)
+
+def load_rates(file_path):
+    """
+    Reads validity counts written by save_rates.
+
+    Args:
+        file_path (str): Path of the JSON file.
+
+    Returns:
+        dict or None: Validity counts as returned by validity_rates, None if the file does not exist.
+    """
+    if not os.path.isfile(file_path):
+        return None
+    with open(file_path, 'r') as file:
+        data = json.load(file)
+    return {'all': data['all'], 'prefix': data['prefix'],
+            'size': {json.loads(size): counts for size, counts in data['size'].items()}}
+
+def station_score(file_name, size, rates, prefix_length=PREFIX_LENGTH):
+    """
+    Estimates how likely a station file is to be valid, relative to the average file.
+
+    The validity rates of the prefix and of the size class of the file are smoothed
+    towards the overall rate and combined assuming they are independent, so that a
+    file without history scores 1.
+
+    Args:
+        file_name (str): Name of the station file.
+        size (int or None): Listed size of the file in bytes.
+        rates (dict): Validity counts as returned by validity_rates.
+        prefix_length (int, optional): Number of leading characters of the station id forming the prefix.
+
+    Returns:
+        float: Positive score, higher for files more likely to be valid.
+    """
+    valid, checked = rates['all']
+    overall = (valid + 1) / (checked + 2)
+    score = 1.0
+    for counts in (rates['prefix'].get(file_name[:prefix_length]), rates['size'].get(size_class(size))):
+        if counts is not None:
+            score *= (counts[0] + PRIOR_WEIGHT * overall) / (counts[1] + PRIOR_WEIGHT) / overall
+    return score
+
+def prioritize_stations(conn, year, file_names, seed=None, prefix_length=PREFIX_LENGTH, rates=None):
+    """
+    Orders candidate station files so that files likely to be valid are fetched first.
+
+    Files are ordered by their score, and files with the same score (such as files of
+    the same network and size class, or all files when no rates are given) are shuffled
+    using the seed. Networks without history score like the average file, so they are
+    still tried before networks which were mostly invalid. The rates are passed in rather
+    than read from the verdicts in the cache, so the order only depends on the seed, the
+    candidates and the given rates.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the cache index.
+        year (int): Year of the station files.
+        file_names (list of str): Candidate station files.
+        seed (int, optional): Seed for shuffling files with the same score.
+        prefix_length (int, optional): Number of leading characters of the station id forming the prefix.
+        rates (dict, optional): Validity counts as returned by validity_rates, None to only shuffle the files.
+
+    Returns:
+        list of str: The candidates in the order to fetch them.
+    """
+    file_names = list(file_names)
+    random.Random(seed).shuffle(file_names)
+    if rates is None:
+        return file_names
+    sizes = dict(conn.execute("SELECT file_name, size FROM catalog WHERE year = ?", (year,)))
+    scores = {file_name: station_score(file_name, sizes.get(file_name), rates, prefix_length)
+              for file_name in file_names}
+    # The sort is stable, so files with the same score keep their shuffled order
+    return sorted(file_names, key=scores.get, reverse=True)
+
+if __name__ == "__main__":
+    # Learn the validity rates from the verdicts in the station cache and write them to the
+    # tracked file which orders the candidates of the download stage
+    rates_file = 'params/validity_rates.json'
+    all_daily_avg_fields = ['DailyAverageDryBulbTemperature',
+                            'DailyMaximumDryBulbTemperature',
+                            'DailyMinimumDryBulbTemperature',
+                            'DailyAverageSeaLevelPressure',
+                            'DailyAverageStationPressure']
+    all_monthly_avg_fields = ['MonthlyMeanTemperature',
+                              'MonthlyMaximumTemperature',
+                              'MonthlyMinimumTemperature',
+                              'MonthlySeaLevelPressure',
+                              'MonthlyStationPressure']
+
+    # Read the cache directory from the YAML file
+    with open('params/params.yaml', 'r') as file:
+        params = yaml.safe_load(file)
+    cache_dir = params['download']['cache_dir']
+
+    # Only learn from verdicts reached with the criteria download.py checks
+    conn = cache.open_cache(cache_dir)
+    criteria = cache.criteria_key(all_daily_avg_fields, all_monthly_avg_fields, True)
+    rates = validity_rates(conn, PREFIX_LENGTH, criteria)
+    conn.close()
+    save_rates(rates, rates_file)
+    print("Learned validity rates from", rates['all'][1], "verdicts into", rates_file)
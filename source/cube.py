@@ -0,0 +1,195 @@
+import os
+import json
+import numpy as np
+import lcd
+
+# Number of days of the day axis, long enough for leap years
+DAYS = 366
+
+def sidecar_path(cube_path):
+    """
+    Returns the path of the JSON sidecar describing a cube.
+
+    Args:
+        cube_path (str): Path of the .npy cube.
+
+    Returns:
+        str: Path of the sidecar.
+    """
+    return os.path.splitext(cube_path)[0] + '.json'
+
+def month_bounds(year):
+    """
+    Computes the day-of-year boundaries of the months of a year.
+
+    Args:
+        year (int): Year of the cube.
+
+    Returns:
+        numpy.ndarray: 13 day indices, month m spanning days bounds[m - 1] to bounds[m] - 1.
+    """
+    months = np.arange('{}-01'.format(year), '{}-02'.format(year + 1), dtype='datetime64[M]')
+    return (months.astype('datetime64[D]') - np.datetime64('{}-01-01'.format(year))).astype(int)
+
+def lay_days(station_cube, dates, values, start, n_days):
+    """
+    Places rows of a station at their day of the year, keeping the last non-empty value of each field on a day.
+
+    Args:
+        station_cube (numpy.ndarray): (366 x fields) slice of the station, updated in place.
+        dates (numpy.ndarray): Array of datetime64 values of the rows.
+        values (numpy.ndarray): 2D array of field values with one column per field.
+        start (numpy.datetime64): First day of the year.
+        n_days (int): Number of days of the year, rows outside the year are dropped.
+    """
+    days = (dates.astype('datetime64[D]') - start).astype(int)
+    in_year = (days >= 0) & (days < n_days)
+    for i in range(values.shape[1]):
+        # Keep the last non-empty value of each day
+        rows = np.nonzero(in_year & ~np.isnan(values[:, i]))[0][::-1]
+        _, first = np.unique(days[rows], return_index=True)
+        rows = rows[first]
+        station_cube[days[rows], i] = values[rows, i]
+
+def build_cube(file_paths, cube_path, fields, year, dtype='float32', chunksize=None):
+    """
+    Lays the fields of all stations into one memory-mapped (stations x 366 x fields) array.
+
+    Every row of a station is placed at its day of the year, keeping the last non-empty
+    value of each field on a day. Days without a value are NaN, so np.isnan(cube) is the
+    mask of missing values. Rows outside the year are dropped. Daily fields without any
+    value in a station are filled with the days resampled from its hourly observations
+    (see lcd.daily_from_hourly), as process.py does for each station. The station names,
+    fields and year are written to a JSON sidecar next to the .npy file.
+
+    Args:
+        file_paths (list of str): Paths of the station files (LCD .csv or ingested .npz).
+        cube_path (str): Path of the .npy file to write.
+        fields (list of str): Fields to store.
+        year (int): Year of the stations.
+        dtype (str): Float dtype of the cube.
+        chunksize (int, optional): Read each station in chunks of this many rows, None to read it at once.
+
+    Returns:
+        numpy.memmap: The cube.
+    """
+    if not isinstance(fields, list):
+        raise TypeError("fields must be a list")
+
+    cube = np.lib.format.open_memmap(cube_path, mode='w+', dtype=dtype, shape=(len(file_paths), DAYS, len(fields)))
+    cube[:] = np.nan
+    start = np.datetime64('{}-01-01'.format(year))
+    n_days = month_bounds(year)[-1]  # 365 or 366, the last day index stays NaN in non-leap years
+    hourly_fields = lcd.hourly_fields(fields)
+    n_fields = len(fields)
+    for station, file_path in enumerate(file_paths):
+        if chunksize is None:
+            chunks = [lcd.read_station(file_path, fields + hourly_fields)]
+        else:
+            chunks = lcd.iter_station_chunks(file_path, fields + hourly_fields, chunksize)
+        has_values = np.zeros(n_fields, dtype=bool)
+        resampled = np.full((DAYS, n_fields), np.nan)  # Days resampled from the hourly observations
+        pending_dates, pending_values = None, None  # Hourly rows of the last day seen so far
+        # Later chunks overwrite the days they share with earlier ones
+        for dates, values in chunks:
+            has_values |= ~np.isnan(values[:, :n_fields]).all(axis=0)
+            lay_days(cube[station], dates, values[:, :n_fields], start, n_days)
+            if not hourly_fields or len(dates) == 0:
+                continue
+
+            # Resample the completed days, keeping the rows of the last day for the next chunk
+            if pending_dates is not None:
+                dates = np.concatenate([pending_dates, dates])
+                values = np.concatenate([pending_values, values])
+            days = dates.astype('datetime64[D]')
+            complete = days < days[-1]
+            pending_dates, pending_values = dates[~complete], values[~complete]
+            lay_days(resampled, *lcd.daily_from_hourly(dates[complete], values[complete, n_fields:],
+                                                       hourly_fields, fields), start, n_days)
+        if pending_dates is not None:
+            lay_days(resampled, *lcd.daily_from_hourly(pending_dates, pending_values[:, n_fields:],
+                                                       hourly_fields, fields), start, n_days)
+
+        # Use the resampled days for the fields without any value
+        station_cube = cube[station]
+        station_cube[:, ~has_values] = resampled[:, ~has_values]
+    cube.flush()
+
+    stations = [os.path.splitext(os.path.basename(file_path))[0] for file_path in file_paths]
+    with open(sidecar_path(cube_path), 'w') as file:
+        json.dump({'stations': stations, 'fields': fields, 'year': year, 'dtype': dtype}, file, indent=1)
+    return cube
+
+def open_cube(cube_path):
+    """
+    Opens a cube without reading it into memory.
+
+    Args:
+        cube_path (str): Path of the .npy cube.
+
+    Returns:
+        tuple: The read-only memory-mapped cube and its sidecar (stations, fields, year and dtype).
+    """
+    with open(sidecar_path(cube_path), 'r') as file:
+        meta = json.load(file)
+    return np.load(cube_path, mmap_mode='r'), meta
+
+def select_fields(cube, meta, fields):
+    """
+    Selects fields of a cube, filling fields which are not stored with NaN.
+
+    Args:
+        cube (numpy.ndarray): (stations x 366 x fields) cube.
+        meta (dict): Sidecar of the cube.
+        fields (list of str): Fields to select.
+
+    Returns:
+        numpy.ndarray: (stations x 366 x len(fields)) float64 array.
+    """
+    selected = np.full(cube.shape[:2] + (len(fields),), np.nan)
+    for i, field in enumerate(fields):
+        if field in meta['fields']:
+            selected[:, :, i] = cube[:, :, meta['fields'].index(field)]
+    return selected
+
+def monthly_last(cube, year):
+    """
+    Finds the last non-empty value of each month for all stations and fields at once.
+
+    Args:
+        cube (numpy.ndarray): (stations x 366 x fields) cube.
+        year (int): Year of the cube.
+
+    Returns:
+        numpy.ndarray: (stations x 12 x fields) array, NaN where a month has no values.
+    """
+    bounds = month_bounds(year)
+
+    # Day of the latest non-empty value at or before each day
+    days = np.arange(cube.shape[1])[None, :, None]
+    latest = np.maximum.accumulate(np.where(np.isnan(cube), -1, days), axis=1)
+    last = latest[:, bounds[1:] - 1]
+    found = last >= bounds[:-1, None]
+    values = np.take_along_axis(cube, np.where(found, last, 0), axis=1)
+    return np.where(found, values, np.nan)
+
+def monthly_means(cube, year):
+    """
+    Computes the mean of each month for all stations and fields at once.
+
+    Args:
+        cube (numpy.ndarray): (stations x 366 x fields) cube.
+        year (int): Year of the cube.
+
+    Returns:
+        numpy.ndarray: (stations x 12 x fields) array, NaN where a month has no values.
+    """
+    bounds = month_bounds(year)
+    starts = bounds[:-1]
+    # The last reduceat segment runs to the end of the axis, so stop it at the end of December
+    cube = cube[:, :bounds[-1]]
+    present = ~np.isnan(cube)
+    sums = np.add.reduceat(np.where(present, cube, 0.0), starts, axis=1)
+    counts = np.add.reduceat(present, starts, axis=1, dtype=int)
+    with np.errstate(invalid='ignore'):
+        return sums / counts
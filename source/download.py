@@ -1,52 +1,76 @@
 import yaml
 import os  
-import pandas as pd  
-import random  
+import csv
+import shutil
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import lcd
+import cache
+import fetch
+import catalog
+import metrics
 
-def get_all_file_names(datafile_path):
+# Strings which pandas.read_csv treats as missing values by default
+NA_VALUES = {'', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+             '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'}
+
+def is_valid_stream(lines, daily_avg_fields, monthly_avg_fields, fields_seen=None, hourly_fallback=True):
     """
-    Selects a random sample of files from the HTML file containing the list of files
+    Checks if CSV data contains valid data based on specified daily and monthly fields.
+
+    Only the header and the required columns are inspected, and reading stops as soon
+    as a pair of daily and monthly fields with values has been seen. With hourly_fallback,
+    a value of the hourly source of a daily field (see lcd.HOURLY_SOURCES) counts as a
+    value of the daily field, since process.py derives missing daily fields from it.
 
     Args:
-        datafile_path (str): Path to the HTML file containing the links
+        lines (iterable of str): Lines of the CSV data, starting with the header.
+        daily_avg_fields (list): List of daily average fields to check.
+        monthly_avg_fields (list): List of monthly average fields to check.
+        fields_seen (set, optional): Collects the fields observed to be non-empty before returning.
+        hourly_fallback (bool, optional): Whether hourly observations can stand in for daily summaries.
 
     Returns:
-        list: A list of all file names.
+        bool: True if the data is valid, False otherwise.
     """
-    # Validate input arguments
-    if not isinstance(datafile_path, str) or not os.path.isfile(datafile_path):
-        raise ValueError("Invalid datafile_path provided.")
-
-    # Read datafile and extract relevant file names
-    with open(datafile_path, "r") as page:
-        data_links = []
-        for line in page:
-            # Check whether we are looking at a line of interest
-            if "href" in line and ".csv" in line:
-                # Extract filename from the link
-                filename = line.split("  ")[0].split('"')[1]
-                data_links.append(filename)
-        # Check if enough files are available for sampling
-        return data_links
-
-def download_html(base_url, year):
-    # Validate input arguments
-    if not isinstance(base_url, str) or not isinstance(year, int):
-        raise ValueError("Invalid input provided for base_url or year.")
-    if not base_url or not year:
-        raise ValueError("base_url and year cannot be empty.")
-
-    # Create a directory to store downloaded HTML file
-    bash_command = "mkdir data/"
-    os.system(bash_command)
-    
-    # Download HTML file containing data links
-    current_dir = os.getcwd()
-    bash_command = "wget -O {}/data/data_store.html {}access/{}".format(current_dir, base_url, year)
-    # Execute the Bash command using os.system
-    os.system(bash_command)
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    if header is None:
+        return False
+
+    # Column indices of field pairs which are present in the header, with the daily
+    # field given by its own column and that of its hourly source
+    pairs = []
+    for daily_field, monthly_field in zip(daily_avg_fields, monthly_avg_fields):
+        sources = [daily_field]
+        if hourly_fallback and daily_field in lcd.HOURLY_SOURCES:
+            sources.append(lcd.HOURLY_SOURCES[daily_field][0])
+        daily = tuple(header.index(field) for field in sources if field in header)
+        if daily and monthly_field in header:
+            pairs.append((daily, header.index(monthly_field)))
+    if not pairs:
+        return False  # The file can be ruled out from its header alone
+    columns = sorted({index for daily, monthly in pairs for index in daily + (monthly,)})
+    width = columns[-1] + 1
+    non_empty = set()
+
+    for row in reader:
+        if len(row) < width:
+            continue
+        for index in columns:
+            if index not in non_empty and row[index] not in NA_VALUES:
+                non_empty.add(index)
+                if fields_seen is not None:
+                    fields_seen.add(header[index])
+                # Check if at least one pair of required fields is not empty
+                if any(monthly in non_empty and any(column in non_empty for column in daily)
+                       for daily, monthly in pairs):
+                    return True
+    return False
 
-def is_valid_file(file_path, daily_avg_fields, monthly_avg_fields):
+def is_valid_file(file_path, daily_avg_fields, monthly_avg_fields, hourly_fallback=True):
     """
     Checks if a CSV file contains valid data based on specified daily and monthly fields.
 
@@ -54,6 +78,7 @@ def is_valid_file(file_path, daily_avg_fields, monthly_avg_fields):
         file_path (str): Path to the CSV file.
         daily_avg_fields (list): List of daily average fields to check.
         monthly_avg_fields (list): List of monthly average fields to check.
+        hourly_fallback (bool, optional): Whether hourly observations can stand in for daily summaries.
 
     Returns:
         bool: True if the file is valid, False otherwise.
@@ -63,22 +88,123 @@ def is_valid_file(file_path, daily_avg_fields, monthly_avg_fields):
     if not isinstance(file_path, str) or not os.path.isfile(file_path):
         raise ValueError("Invalid file_path provided.")
 
-    # Read the csv file
-    df = pd.read_csv(file_path, low_memory=False)
-    for daily_field, monthly_field in zip(daily_avg_fields, monthly_avg_fields):
-        # Check if at least one pair of required fields is not empty
-        if not df[daily_field].dropna().empty and not df[monthly_field].dropna().empty:
-            return True
-    return False
+    # Stream the csv file
+    with open(file_path, 'r', newline='') as file:
+        return is_valid_stream(file, daily_avg_fields, monthly_avg_fields, hourly_fallback=hourly_fallback)
+
+def stream_lines(chunks, stop_event):
+    """
+    Yields the decoded lines of a file which is being downloaded.
+
+    Args:
+        chunks (iterator of bytes): Chunks of the file contents.
+        stop_event (threading.Event): Stops the transfer once set.
+
+    Yields:
+        str: Lines of the file, including line endings.
+    """
+    remainder = b''
+    for chunk in chunks:
+        # Abort the transfer if the search is already over
+        if stop_event.is_set():
+            return
+        lines = (remainder + chunk).split(b'\n')
+        remainder = lines.pop()
+        for line in lines:
+            yield line.decode('utf-8', errors='replace') + '\n'
+    if remainder:
+        yield remainder.decode('utf-8', errors='replace')
+
+def fetch_candidate(session, download_url, file_path, daily_avg_fields, monthly_avg_fields, stop_event,
+                    timeout=60, retries=3, stats=None, hourly_fallback=True):
+    """
+    Downloads a single candidate file and checks its validity while it is streamed.
+
+    Invalid files are removed from disk. Failed or cancelled transfers keep their partial
+    file, so that a later run can resume them.
+
+    Args:
+        session (requests.Session): Shared HTTP session.
+        download_url (str): URL of the candidate file.
+        file_path (str): Local path to store the file at.
+        daily_avg_fields (list): List of daily average fields to check.
+        monthly_avg_fields (list): List of monthly average fields to check.
+        stop_event (threading.Event): Set once enough valid files have been found.
+        timeout (float, optional): Connect and read timeout in seconds.
+        retries (int, optional): Number of retries for a failed transfer.
+        stats (dict, optional): Receives the byte counts and checksum of the transfer, also
+            when it fails or is cancelled.
+        hourly_fallback (bool, optional): Whether hourly observations can stand in for daily summaries.
+
+    Returns:
+        tuple or None: (valid, fields_seen, stats) for a completed check, where stats holds the
+        byte counts and checksum of the transfer. None if the download failed or was cancelled.
+    """
+    fields_seen = set()
+    stats = {} if stats is None else stats
+    chunks = fetch.iter_fetch(session, download_url, file_path, stats, timeout, retries)
+    try:
+        # Validate the file while it is being transferred
+        valid = is_valid_stream(stream_lines(chunks, stop_event), daily_avg_fields, monthly_avg_fields, fields_seen,
+                                hourly_fallback)
+        if valid:
+            # The file is ruled in, so store the rest of it without parsing
+            for _ in chunks:
+                if stop_event.is_set():
+                    break
+    except requests.RequestException as error:
+        print("Failed to download", download_url, ":", error)
+        return None
+    finally:
+        # An invalid file is ruled out by now, and closing the transfer aborts it
+        chunks.close()
+    if stop_event.is_set():
+        return None
+
+    if not valid:
+        # Delete the invalid file, whether or not it was downloaded completely
+        for path in (file_path, file_path + '.part', file_path + '.part.json'):
+            if os.path.isfile(path):
+                os.remove(path)
+    return valid, fields_seen, stats
 
-def download_csv(base_url, year, n_locs):
+def download_csv(base_url, year, n_locs, seed=None, workers=8, data_dir='data', cache_dir='.station_cache',
+                 timeout=60, retries=3, min_size=None, max_size=None, counters=None, hourly_fallback=True,
+                 rates=None):
     """
     Downloads CSV files from a specified URL for a given year and number of locations.
 
+    Files and their validity verdicts are kept in a persistent cache, along with a catalog
+    of the station listing which is only refetched when it changed. Candidates are drawn
+    in a seeded random order, favouring the station networks and file sizes which the given
+    validity rates found mostly valid (see catalog.prioritize_stations), and walked in that order:
+    known invalid files are skipped, known valid files are restored from the cache and the
+    remaining candidates are fetched concurrently over a shared connection pool. A candidate
+    is only fetched while the files found valid, the known valid files queued and the
+    downloads in flight number less than n_locs (and at most 2 * workers downloads are in
+    flight), so a re-run whose selection is cached transfers nothing. Results are accepted in candidate order, so the
+    selected files are the first n_locs valid files of the order. They only depend on the
+    seed, the catalog and the rates, and not on download timing or on the verdicts
+    recorded in the cache.
+
     Args:
         base_url (str): Base URL for downloading files.
         year (str): Year for which data is to be downloaded.
         n_locs (int): Number of locations to download data for.
+        seed (int, optional): Seed for ordering the list of candidate files.
+        workers (int, optional): Number of concurrent downloads.
+        data_dir (str, optional): Directory to store the selected files in.
+        cache_dir (str, optional): Directory holding the station cache.
+        timeout (float, optional): Connect and read timeout of each transfer in seconds.
+        retries (int, optional): Number of retries for a failed transfer.
+        min_size (int, optional): Only consider station files of at least this many bytes.
+        max_size (int, optional): Only consider station files of at most this many bytes.
+        counters (dict, optional): Receives the number of candidates checked, found valid and
+            restored from the cache, the bytes fetched and the number and size of the selected files.
+        hourly_fallback (bool, optional): Whether hourly observations can stand in for daily summaries.
+            Verdicts recorded with another setting or other fields are rechecked.
+        rates (dict, optional): Validity counts to order the candidates by (see catalog.load_rates),
+            None to keep the seeded order.
 
     Returns:
         int: Status code indicating success or failure of the download process.
@@ -91,11 +217,8 @@ def download_csv(base_url, year, n_locs):
         raise ValueError("Invalid input provided for base_url, year, or n_locs.")
     if not base_url or not year or n_locs <= 0:
         raise ValueError("base_url, year, and n_locs must be valid.")
-
-    # Download HTML file containing data links
-    download_html(base_url, year)
-    list_files = get_all_file_names('data/data_store.html')
-    random.shuffle(list_files)  # Shuffle the list of files
+    if not isinstance(workers, int) or workers <= 0:
+        raise ValueError("workers must be a positive integer.")
 
     # Define daily and monthly average fields
     daily_avg_fields = ['DailyAverageDryBulbTemperature', 
@@ -109,36 +232,122 @@ def download_csv(base_url, year, n_locs):
                           'MonthlyMinimumTemperature',
                           'MonthlySeaLevelPressure', 
                           'MonthlyStationPressure']
+    # Verdicts reached with other fields or rules count as unknown
+    criteria = cache.criteria_key(daily_avg_fields, monthly_avg_fields, hourly_fallback)
+
+    # Refresh the station catalog and look up the candidate files in it
+    conn = cache.open_cache(cache_dir)
+    os.makedirs(data_dir, exist_ok=True)
+    session = fetch.create_session(workers, retries)
+    catalog.refresh_catalog(conn, session, base_url, year, cache_dir, timeout)
+    list_files = catalog.sample_stations(conn, year, min_size, max_size)
+    # Order the files by their chance of being valid according to the rates
+    list_files = catalog.prioritize_stations(conn, year, list_files, seed, rates=rates)
 
+    # Walk the candidates in order, skipping known invalid files and restoring known valid
+    # files instead of fetching them, so the verdicts only save work and never change the selection.
+    # Verdicts reached on an older version of a file (another listed size or modification time) are unknown
+    verdicts = cache.get_verdicts(conn, year, criteria)
+    listed = catalog.listed_entries(conn, year)
+    candidates = iter([file_name for file_name in list_files if verdicts.get(file_name, (True,))[0]])
+    os.makedirs(cache.cached_file_path(cache_dir, year, ''), exist_ok=True)
+
+    counters = {} if counters is None else counters
+    counters.update({'candidates_tried': 0, 'candidates_valid': 0, 'candidates_cached': 0, 'bytes_fetched': 0})
+    transfers = []  # Stats of every transfer
+    selected = []  # Paths of the selected files
     valid_file_count = 0
     print("Searching for valid files......")
-    for file_name in list_files:
-        # Download file
-        base_url_year = base_url + "access/" + str(year) + "/"
-        download_url = f"{base_url_year}{file_name}"
-        path = os.path.join(os.getcwd(), 'data')
-        fetch_command = f"wget {download_url} -P {path} -q"
-        os.system(fetch_command)        
-        file_path = os.path.join(os.path.join(os.getcwd(), 'data'), file_name)
-        # Check file validity
-        if is_valid_file(file_path, daily_avg_fields, monthly_avg_fields):
-            print(valid_file_count + 1, "out of", n_locs, "required files found")
-            valid_file_count += 1
-            if valid_file_count >= n_locs:
-                return 1  # Found n_locs valid files, return 1
-        else:
-            # Delete invalid file
-            os.remove(file_path)
+    base_url_year = base_url + "access/" + str(year) + "/"
+    stop_event = threading.Event()
+    pending = deque()  # (file_name, future) pairs in candidate order, future None for known valid files
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def submit(file_name):
+            file_path = cache.cached_file_path(cache_dir, year, file_name)
+            transfers.append({})
+            return executor.submit(fetch_candidate, session, base_url_year + file_name, file_path,
+                                   daily_avg_fields, monthly_avg_fields, stop_event, timeout, retries,
+                                   transfers[-1], hourly_fallback)
+
+        def fill_queue():
+            # Only queue candidates which may still be needed: the files found valid, the known
+            # valid files and the downloads in flight stay below n_locs, so a warm cache
+            # holding the selection is restored without any transfer
+            while valid_file_count + len(pending) < n_locs:
+                if sum(future is not None for _, future in pending) >= 2 * workers:
+                    return
+                file_name = next(candidates, None)
+                if file_name is None:
+                    return
+                pending.append((file_name, None if file_name in verdicts else submit(file_name)))
+
+        while True:
+            fill_queue()
+            if not pending or valid_file_count >= n_locs:
+                break
+            # Check file validity in candidate order
+            file_name, future = pending.popleft()
+            if future is None:
+                _, size, sha256 = verdicts[file_name]
+                if cache.restore_file(cache.cached_file_path(cache_dir, year, file_name),
+                                      os.path.join(data_dir, file_name), size, sha256):
+                    print(valid_file_count + 1, "out of", n_locs, "required files found (cached)")
+                    valid_file_count += 1
+                    counters['candidates_cached'] += 1
+                    selected.append(os.path.join(data_dir, file_name))
+                else:
+                    # Refetch missing or corrupted cache entries in their place
+                    pending.appendleft((file_name, submit(file_name)))
+                continue
+
+            result = future.result()
+            if result is None:
+                continue
+            valid, fields_seen, stats = result
+            cache.record_verdict(conn, year, file_name, valid, fields_seen, stats.get('size'), stats.get('sha256'),
+                                 criteria, listed.get(file_name))
+            counters['candidates_tried'] += 1
+            counters['candidates_valid'] += int(valid)
+            if valid:
+                shutil.copyfile(cache.cached_file_path(cache_dir, year, file_name), os.path.join(data_dir, file_name))
+                selected.append(os.path.join(data_dir, file_name))
+                print(valid_file_count + 1, "out of", n_locs, "required files found")
+                valid_file_count += 1
+
+        # Cancel outstanding downloads once enough valid files are found
+        stop_event.set()
+        pending = [(file_name, future) for file_name, future in pending if future is not None]
+        for _, future in pending:
+            future.cancel()
+
+    # Keep verdicts of downloads which completed beyond the first n_locs
+    for file_name, future in pending:
+        if not future.cancelled() and future.result() is not None:
+            valid, fields_seen, stats = future.result()
+            cache.record_verdict(conn, year, file_name, valid, fields_seen, stats.get('size'), stats.get('sha256'),
+                                 criteria, listed.get(file_name))
+            counters['candidates_tried'] += 1
+            counters['candidates_valid'] += int(valid)
+    session.close()
+    conn.close()
+
+    # Bytes of all transfers, including the ones which were ruled out early or cancelled
+    counters['bytes_fetched'] = sum(stats.get('bytes_fetched', 0) for stats in transfers)
+    counters['files'] = len(selected)
+    counters['bytes'] = sum(os.path.getsize(file_path) for file_path in selected)
     
     # Check conditions and return appropriate value
     if valid_file_count == 0:
         return 0  # No valid files found
     elif valid_file_count < n_locs:
         return 2  # Found at least one file but less than n_locs valid files
+    return 1  # Found n_locs valid files
 
 if __name__ == "__main__":
     # Define base url
     base_url = 'https://www.ncei.noaa.gov/data/local-climatological-data/'
+    # Validity rates ordering the candidates, tracked as a dependency of the stage (see catalog.py)
+    rates_file = 'params/validity_rates.json'
     # Read YAML file
     with open('params/params.yaml', 'r') as file:
         data = yaml.safe_load(file)
@@ -146,6 +355,16 @@ if __name__ == "__main__":
     # Extract variables
     n_locs = data['download']['n_locs']
     year = data['download']['year']
+    seed = data['download']['seed']
+    workers = data['download']['workers']
+    cache_dir = data['download']['cache_dir']
+    timeout = data['download']['timeout']
+    retries = data['download']['retries']
+    min_size = data['download']['min_size']
+    max_size = data['download']['max_size']
+    profile = data['metrics']['profile']
 
-    # Call the main function
-    download_csv(base_url, year, n_locs)
+    # Call the main function, recording its metrics
+    with metrics.stage_metrics('download', profile=profile) as counters:
+        download_csv(base_url, year, n_locs, seed, workers, cache_dir=cache_dir, timeout=timeout, retries=retries,
+                     min_size=min_size, max_size=max_size, counters=counters, rates=catalog.load_rates(rates_file))
@@ -1,29 +1,104 @@
+import os
 import numpy as np
-from sklearn.metrics import r2_score
 import csv
+import yaml
 import pandas as pd
+import metrics
+import tables
 
-def read_mycsv(file_path):
+def read_monthly_table(file_path):
     """
-    Read data from a CSV file into a list of lists, handling 'nan' values as np.nan.
+    Read a monthly table (Location, Month and one column per field) into a single float array.
+
+    Binary .npz tables are loaded directly, CSV tables are parsed.
 
     Args:
-    file_path (str): Path to the CSV file.
+    file_path (str): Path to the .npz or CSV file.
 
     Returns:
-    list: A list of lists representing the data from the CSV file.
+    tuple: An array of the unique locations, a list of field names and a
+    (locations x 12 x fields) float array of the monthly values.
     """
     if not isinstance(file_path, str):
         raise TypeError("File path must be a string")
     
-    data = []
-    with open(file_path, 'r') as csvfile:
-        reader = csv.reader(csvfile)  # Create a CSV reader object
-        next(reader)  # Skip the header row
-        for row in reader:
-            # Convert each element in the row to float if it's not 'nan', otherwise assign np.nan
-            data.append([float(val) if val != 'nan' else np.nan for val in row])
-    return data
+    if file_path.endswith('.npz'):
+        return tables.read_table(file_path)
+    
+    # Parse the file once, with exactly rounded floats as float() would give
+    df = pd.read_csv(file_path, float_precision='round_trip')
+    
+    # Check if the number of rows in the CSV is a multiple of 12
+    if len(df) % 12 != 0:
+        raise ValueError("The number of rows in the CSV files must be a multiple of 12")
+    
+    field_names = list(df.columns[2:])  # Exclude Location and Month columns
+    values = df[field_names].to_numpy(dtype=np.float64).reshape(-1, 12, len(field_names))
+    return df['Location'].unique(), field_names, values
+
+def pairwise_sum(values, count):
+    """
+    Sum 8 to 12 zero-padded values along the last axis in the order of NumPy's pairwise summation.
+
+    This keeps the vectorized R-squared values bit-identical to summing each valid
+    sequence separately, as sklearn.metrics.r2_score does.
+
+    Args:
+    values (numpy.ndarray): Array whose last axis holds the values to sum, padded with zeros.
+    count (numpy.ndarray): Number of values before the padding.
+
+    Returns:
+    numpy.ndarray: The sums, with the last axis removed.
+    """
+    # Fewer than 8 values are added one after another
+    sequential = np.zeros(values.shape[:-1])
+    for i in range(values.shape[-1]):
+        sequential = sequential + values[..., i]
+    
+    # 8 or more values are added in 8 partial sums first
+    v = [values[..., i] for i in range(8)]
+    blocked = ((v[0] + v[1]) + (v[2] + v[3])) + ((v[4] + v[5]) + (v[6] + v[7]))
+    for i in range(8, values.shape[-1]):
+        blocked = blocked + values[..., i]
+    return np.where(count >= 8, blocked, sequential)
+
+def r2_matrix(monthly_avg_gt, monthly_avg_est):
+    """
+    Compute R-squared values for all locations and fields at once.
+
+    For each location and field, months where either value is NaN are ignored. Fewer
+    than two valid months give NaN, and a constant ground truth gives 1.0 for a perfect
+    estimate and 0.0 otherwise, as in sklearn.metrics.r2_score.
+
+    Args:
+    monthly_avg_gt (numpy.ndarray): (locations x 12 x fields) ground truth values.
+    monthly_avg_est (numpy.ndarray): (locations x 12 x fields) estimated values.
+
+    Returns:
+    numpy.ndarray: A (locations x fields) array of R-squared values.
+    """
+    if monthly_avg_gt.shape != monthly_avg_est.shape:
+        raise ValueError("Ground truth and estimate must have the same shape")
+    
+    # Move the months to the last axis and pack the valid months of each series to the front
+    gt = np.moveaxis(monthly_avg_gt, 1, -1)
+    est = np.moveaxis(monthly_avg_est, 1, -1)
+    valid = ~(np.isnan(gt) | np.isnan(est))
+    order = np.argsort(~valid, axis=-1, kind='stable')
+    valid = np.take_along_axis(valid, order, axis=-1)
+    gt = np.where(valid, np.take_along_axis(gt, order, axis=-1), 0.0)
+    est = np.where(valid, np.take_along_axis(est, order, axis=-1), 0.0)
+    count = valid.sum(axis=-1)
+    
+    # Residual and total sums of squares
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = pairwise_sum(gt, count) / count
+        numerator = pairwise_sum(np.where(valid, (gt - est) ** 2, 0.0), count)
+        denominator = pairwise_sum(np.where(valid, (gt - mean[..., None]) ** 2, 0.0), count)
+        r2 = np.where(numerator == 0, 1.0, np.where(denominator == 0, 0.0, 1 - numerator / denominator))
+    
+    # R-squared is not defined with less than two samples
+    return np.where(count < 2, np.nan, r2)
 
 def compute_r2(monthly_avg_gt_file, monthly_avg_est_file):
     """
@@ -40,60 +115,9 @@ def compute_r2(monthly_avg_gt_file, monthly_avg_est_file):
         raise TypeError("File paths must be strings")
     
     # Read ground truth and estimated data from CSV files
-    monthly_avg_gt = read_mycsv(monthly_avg_gt_file)
-    monthly_avg_est = read_mycsv(monthly_avg_est_file)
-    
-    # Check if the number of rows in each CSV is a multiple of 12
-    if len(monthly_avg_gt) % 12 != 0 or len(monthly_avg_est) % 12 != 0:
-        raise ValueError("The number of rows in the CSV files must be a multiple of 12")
-    
-    # Calculate the number of locations
-    num_locations = len(monthly_avg_gt) // 12
-    r2_values = []
-
-    for i in range(num_locations):
-        start_index = i * 12
-        end_index = (i + 1) * 12
-        
-        # Extract monthly average data for each location
-        gt_avg = monthly_avg_gt[start_index:end_index]
-        est_avg = monthly_avg_est[start_index:end_index]
-        nan_fields_indices = []  # List to store field indices with all NaN values
-        
-        # Iterate over each field
-        for j in range(2, len(gt_avg[0])):
-            # Extract data for each field
-            field_gt_avg = [row[j] for row in gt_avg]
-            field_est_avg = [row[j] for row in est_avg]  
-            # Check if all values in the field are NaN
-            if all(np.isnan(val) for val in field_gt_avg) and all(np.isnan(val) for val in field_est_avg):
-                nan_fields_indices.append(j)
-
-        r2_location = []
-        
-        # Iterate over each field
-        for j in range(2, len(gt_avg[0])):
-            if j not in nan_fields_indices:
-                field_gt_avg = [row[j] for row in gt_avg]
-                field_est_avg = [row[j] for row in est_avg]
-                
-                # Find indices where both corresponding values are not NaN
-                valid_indices = [idx for idx, (x, y) in enumerate(zip(field_gt_avg, field_est_avg)) if not (np.isnan(x) or np.isnan(y))]
-                valid_gt_avg = [field_gt_avg[idx] for idx in valid_indices]
-                valid_est_avg = [field_est_avg[idx] for idx in valid_indices]
-
-                # Compute R-squared value for the field
-                if len(valid_gt_avg) == 0 or len(valid_est_avg) == 0:
-                    r2 = np.nan
-                else:
-                    r2 = r2_score(valid_gt_avg, valid_est_avg)
-            else:
-                r2 = np.nan
-            r2_location.append(r2)
-        
-        r2_values.append(r2_location)
-    
-    return r2_values
+    _, _, monthly_avg_gt = read_monthly_table(monthly_avg_gt_file)
+    _, _, monthly_avg_est = read_monthly_table(monthly_avg_est_file)
+    return r2_matrix(monthly_avg_gt, monthly_avg_est).tolist()
 
 def get_field_names(file_path):
     """
@@ -132,6 +156,26 @@ def get_locations(file_path):
     unique_locations = df['Location'].unique()
     return unique_locations
 
+def csv_locations(locations):
+    """
+    Format locations as the evaluate output has always written them.
+
+    The output used to take its locations from the Location column of the monthly CSV
+    files as parsed by pandas, which reads numeric station identifiers as integers and so
+    drops their leading zeros. Locations handed over as text (from the .npz tables or in
+    memory) are formatted the same way, so the output does not depend on the entry point.
+
+    Args:
+    locations (numpy.ndarray): Array of unique locations.
+
+    Returns:
+    list: The locations as written to the CSV file.
+    """
+    try:
+        return [int(location) for location in locations]
+    except ValueError:
+        return [str(location) for location in locations]
+
 def convert_to_csv(output_file, r2_values, field_names, locations):
     """
     Convert R-squared values into a CSV file.
@@ -153,6 +197,7 @@ def convert_to_csv(output_file, r2_values, field_names, locations):
     
     # Prepare data for CSV
     data = []
+    locations = csv_locations(locations)
     for i, r2_location in enumerate(r2_values):
         location_row = [locations[i]]  # Location identifier
         location_row.extend(r2_location)  # Append R-squared values for each field
@@ -169,8 +214,21 @@ def convert_to_csv(output_file, r2_values, field_names, locations):
             writer.writerow(row)
 
 if __name__ == "__main__":
-    monthly_avg_gt_file = 'outputs/prepare_output.csv'
-    monthly_avg_est_file = 'outputs/process_output.csv'
-    locations = get_locations(monthly_avg_est_file)  # Get unique locations from the estimated CSV file
-    r2_values = compute_r2(monthly_avg_gt_file, monthly_avg_est_file)  # Compute R-squared values
-    convert_to_csv('outputs/evaluate_output.csv',r2_values,get_field_names(monthly_avg_gt_file),locations)
+    monthly_avg_gt_file = 'outputs/prepare_output.npz'
+    monthly_avg_est_file = 'outputs/process_output.npz'
+    # Read the profiling switch from the YAML file
+    with open('params/params.yaml', 'r') as file:
+        profile = yaml.safe_load(file)['metrics']['profile']
+
+    with metrics.stage_metrics('evaluate', profile=profile) as counters:
+        # Load the binary monthly tables
+        _, field_names, monthly_avg_gt = read_monthly_table(monthly_avg_gt_file)
+        locations, _, monthly_avg_est = read_monthly_table(monthly_avg_est_file)  # Locations of the estimates
+        r2 = r2_matrix(monthly_avg_gt, monthly_avg_est)  # Compute R-squared values
+        tables.write_table('outputs/evaluate_output.npz', locations, field_names, r2)
+        convert_to_csv('outputs/evaluate_output.csv',r2.tolist(),field_names,locations)
+
+        # Record the files read and the rows written
+        counters['files'] = 2
+        counters['bytes'] = os.path.getsize(monthly_avg_gt_file) + os.path.getsize(monthly_avg_est_file)
+        counters['rows'] = len(locations)
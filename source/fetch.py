@@ -0,0 +1,248 @@
+import os
+import json
+import time
+import hashlib
+import requests
+from urllib3.util.retry import Retry
+
+# HTTP status codes which are worth retrying
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+def create_session(pool_size, retries=3, backoff=1.0):
+    """
+    Creates an HTTP session whose connection pool keeps pool_size keep-alive connections open.
+
+    Failed connections and retryable HTTP statuses are retried with exponential backoff.
+
+    Args:
+        pool_size (int): Maximum number of pooled connections per host.
+        retries (int): Number of retries for a failed request.
+        backoff (float): Backoff factor in seconds between retries.
+
+    Returns:
+        requests.Session: Session to be shared by all download threads.
+    """
+    retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=RETRY_STATUSES,
+                  allowed_methods=['GET'], raise_on_status=False)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def response_validator(response):
+    """
+    Returns the validator of a response which can be sent as If-Range.
+
+    Args:
+        response (requests.Response): Response of the server.
+
+    Returns:
+        str or None: The strong ETag, or else the Last-Modified time of the response, None if
+        the server sent neither.
+    """
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('Last-Modified')
+
+def content_range(response):
+    """
+    Parses the Content-Range header of a 206 or 416 response.
+
+    Args:
+        response (requests.Response): Response of the server.
+
+    Returns:
+        tuple: The first byte of the range (None for an unsatisfied range) and the total size
+        of the file (None if unknown or missing).
+    """
+    value = response.headers.get('Content-Range', '')
+    if not value.startswith('bytes '):
+        return None, None
+    byte_range, _, total = value[len('bytes '):].partition('/')
+    start = int(byte_range.split('-')[0]) if byte_range != '*' else None
+    return start, int(total) if total.isdigit() else None
+
+def iter_fetch(session, url, file_path, stats=None, timeout=60, retries=3, backoff=1.0):
+    """
+    Downloads a file into file_path + '.part' and yields its contents chunk by chunk.
+
+    A partial file left behind by an interrupted transfer is resumed with an HTTP Range
+    request, and transfers interrupted midway are retried with exponential backoff. The
+    validator (ETag or Last-Modified) of the transfer is kept next to the partial file in
+    file_path + '.part.json' and sent as If-Range, so that a file changed upstream is sent
+    again in full. The partial file is only resumed when the server confirms it: a 206
+    response starting at its end, or a 416 response whose total size equals its size.
+    Otherwise it is discarded and the file is fetched from its first byte. The chunks
+    always cover the whole file from its first byte, including the bytes which were
+    already on disk. Once the transfer is complete, the partial file is atomically renamed
+    to file_path. If the iteration is stopped early, the partial file is kept so that a
+    later call can resume it.
+
+    Args:
+        session (requests.Session): HTTP session to use.
+        url (str): URL of the file.
+        file_path (str): Path to store the file at.
+        stats (dict, optional): Receives 'bytes_fetched' (bytes transferred over the network),
+            'size' and 'sha256' of the completed file.
+        timeout (float): Connect and read timeout in seconds.
+        retries (int): Number of retries for an interrupted transfer.
+        backoff (float): Backoff factor in seconds between retries.
+
+    Yields:
+        bytes: Chunks of the file contents.
+
+    Raises:
+        requests.RequestException: If the transfer failed, or if the file changed upstream
+            after some of its bytes were yielded.
+    """
+    stats = {} if stats is None else stats
+    stats['bytes_fetched'] = 0
+    part_path = file_path + '.part'
+    validator_path = part_path + '.json'
+    digest = hashlib.sha256()
+
+    # A partial file can only be resumed if the validator of its transfer is known
+    validator = None
+    if os.path.isfile(validator_path):
+        with open(validator_path, 'r') as file:
+            validator = json.load(file)['validator']
+    offset = os.path.getsize(part_path) if validator is not None and os.path.isfile(part_path) else 0
+    yielded = 0  # Bytes passed on to the caller
+
+    attempt = 0
+    with open(part_path, 'ab') as part:
+        def restart():
+            # Discard the partial file, failing if the caller already saw some of its bytes
+            part.seek(0)
+            part.truncate()
+            if os.path.isfile(validator_path):
+                os.remove(validator_path)
+            if yielded:
+                raise requests.RequestException("{} changed upstream during the transfer".format(url))
+            return 0
+
+        def replay():
+            # Pass on the bytes of the partial file which were not yielded yet
+            with open(part_path, 'rb') as held:
+                held.seek(yielded)
+                for block in iter(lambda: held.read(min(1 << 16, offset - held.tell())), b''):
+                    digest.update(block)
+                    yield block
+
+        if not offset:
+            offset = restart()
+        while True:
+            headers = {'Range': 'bytes={}-'.format(offset), 'If-Range': validator} if offset else {}
+            try:
+                with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+                    if response.status_code == 416:
+                        if content_range(response)[1] != offset:
+                            # The partial file does not match the file on the server
+                            offset = restart()
+                            continue
+                        # The partial file is already complete
+                        for block in replay():
+                            yielded += len(block)
+                            yield block
+                        break
+                    response.raise_for_status()
+
+                    skip = 0
+                    if response.status_code == 206 and content_range(response)[0] != offset:
+                        offset = restart()
+                        continue
+                    if response.status_code == 200 and offset:
+                        if response_validator(response) != validator:
+                            # The file changed upstream and is sent in full
+                            offset = restart()
+                        else:
+                            # The server ignored the Range header, so skip the bytes already on disk
+                            skip = offset
+                    if not offset:
+                        # Keep the validator of a new transfer, so that it can be resumed
+                        validator = response_validator(response)
+                        if validator is not None:
+                            with open(validator_path, 'w') as file:
+                                json.dump({'validator': validator}, file)
+                    for block in replay():
+                        yielded += len(block)
+                        yield block
+
+                    for chunk in response.iter_content(chunk_size=1 << 16):
+                        stats['bytes_fetched'] += len(chunk)
+                        if skip:
+                            chunk, skip = chunk[skip:], max(0, skip - len(chunk))
+                            if not chunk:
+                                continue
+                        part.write(chunk)
+                        digest.update(chunk)
+                        offset += len(chunk)
+                        yielded += len(chunk)
+                        yield chunk
+                break
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+                if attempt >= retries:
+                    raise
+                part.flush()
+                time.sleep(backoff * 2 ** attempt)
+                attempt += 1
+
+    os.replace(part_path, file_path)
+    if os.path.isfile(validator_path):
+        os.remove(validator_path)
+    stats['size'] = offset
+    stats['sha256'] = digest.hexdigest()
+
+def fetch_file(session, url, file_path, timeout=60, retries=3, backoff=1.0):
+    """
+    Downloads a file, resuming and retrying interrupted transfers, and writes it atomically.
+
+    Args:
+        session (requests.Session): HTTP session to use.
+        url (str): URL of the file.
+        file_path (str): Path to store the file at.
+        timeout (float): Connect and read timeout in seconds.
+        retries (int): Number of retries for an interrupted transfer.
+        backoff (float): Backoff factor in seconds between retries.
+
+    Returns:
+        dict: 'bytes_fetched' (bytes transferred over the network), 'size' and 'sha256' of the file.
+    """
+    stats = {}
+    for _ in iter_fetch(session, url, file_path, stats, timeout, retries, backoff):
+        pass
+    return stats
+
+def fetch_if_modified(session, url, file_path, etag=None, last_modified=None, timeout=60):
+    """
+    Downloads a file with a conditional GET, skipping the transfer if it is unchanged since it was last fetched.
+
+    Args:
+        session (requests.Session): HTTP session to use.
+        url (str): URL of the file.
+        file_path (str): Path to store the file at.
+        etag (str, optional): ETag of the earlier download, sent as If-None-Match.
+        last_modified (str, optional): Last-Modified of the earlier download, sent as If-Modified-Since.
+        timeout (float): Connect and read timeout in seconds.
+
+    Returns:
+        dict or None: 'etag' and 'last_modified' validators of the downloaded file, None if it is unchanged.
+    """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+
+    with session.get(url, headers=headers, timeout=timeout) as response:
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+        # Write to a temporary file first, so an interrupted download never replaces a good file
+        temp_path = file_path + '.part'
+        with open(temp_path, 'wb') as file:
+            file.write(response.content)
+    os.replace(temp_path, file_path)
+    return {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
@@ -0,0 +1,162 @@
+import os
+import yaml
+import shutil
+import hashlib
+import lcd
+import cube
+import metrics
+import partials
+
+def ingest_station(file_path, output_path, fields, chunksize=None):
+    """
+    Parses a station CSV file once and stores its dates and fields as a columnar .npz file.
+
+    Args:
+        file_path (str): Path to the LCD CSV file.
+        output_path (str): Path of the .npz file to write.
+        fields (list of str): Fields to keep.
+        chunksize (int, optional): Stream the file in chunks of this many rows, None to read it at once.
+
+    Returns:
+        int: Number of rows of the station.
+    """
+    if chunksize is not None:
+        return lcd.write_station_chunks(output_path, lcd.iter_lcd_chunks(file_path, fields, chunksize), fields)
+
+    dates, values = lcd.read_lcd(file_path, fields)
+    lcd.write_station(output_path, dates, values, fields)
+    return len(dates)
+
+def ingest_folder(folder_path, output_folder, fields, counters=None, store_dir=None, chunksize=None):
+    """
+    Ingests every station CSV file of a folder into one .npz file per station.
+
+    With a store_dir, stations are taken from the shared store of ingested stations and
+    only CSV files which are not in the store yet are parsed. Files are looked up by their
+    checksum, which is only recomputed for files whose size or modification time changed,
+    so adding stations costs time proportional to the new stations.
+
+    Args:
+        folder_path (str): Path to the folder containing CSV files.
+        output_folder (str): Path to the folder to write the .npz files to.
+        fields (list of str): Fields to keep.
+        counters (dict, optional): Receives the number of files, rows and bytes ingested, and
+            the number of files parsed.
+        store_dir (str, optional): Directory of a persistent store of ingested stations.
+        chunksize (int, optional): Stream each CSV file in chunks of this many rows to bound memory use.
+
+    Returns:
+        list of str: Paths of the written .npz files.
+    """
+    if not isinstance(folder_path, str) or not os.path.isdir(folder_path):
+        raise ValueError("Invalid folder_path provided.")
+
+    os.makedirs(output_folder, exist_ok=True)
+    counters = {} if counters is None else counters
+    counters.update({'files': 0, 'rows': 0, 'bytes': 0, 'files_parsed': 0})
+    if store_dir is not None:
+        os.makedirs(store_dir, exist_ok=True)
+        index_path = os.path.join(store_dir, 'hashes.json')
+        hash_index = partials.load_hash_index(index_path)
+    output_paths = []
+    for file_name in sorted(os.listdir(folder_path)):
+        if file_name.endswith('.csv'):
+            file_path = os.path.join(folder_path, file_name)
+            output_path = os.path.join(output_folder, file_name[:-4] + '.npz')
+            if store_dir is None:
+                rows = ingest_station(file_path, output_path, fields, chunksize)
+                counters['files_parsed'] += 1
+            else:
+                # Parse the station only if it is not in the store yet
+                store_path = stored_path(file_path, store_dir, fields, hash_index)
+                if not os.path.isfile(store_path):
+                    ingest_to_store(file_path, store_dir, fields, hash_index, chunksize)
+                    counters['files_parsed'] += 1
+                shutil.copyfile(store_path, output_path)
+                rows = lcd.station_rows(output_path)
+            counters['rows'] += rows
+            counters['files'] += 1
+            counters['bytes'] += os.path.getsize(file_path)
+            output_paths.append(output_path)
+    if store_dir is not None:
+        partials.save_hash_index(index_path, hash_index)
+    return output_paths
+
+def stored_path(file_path, store_dir, fields, hash_index=None):
+    """
+    Returns the path under which a station file is kept in a shared store of ingested stations.
+
+    Stations are keyed by the contents of the CSV file, the fields and the version of the
+    ingestion code, so identical downloads in different data folders share one ingested file.
+
+    Args:
+        file_path (str): Path to the LCD CSV file.
+        store_dir (str): Directory of the shared store.
+        fields (list of str): Fields to keep.
+        hash_index (dict, optional): Index of previously computed checksums, updated in place, so
+            that unchanged files are not read again.
+
+    Returns:
+        str: Path of the ingested .npz file in the store.
+    """
+    checksum = partials.file_sha256(file_path) if hash_index is None else partials.cached_sha256(file_path, hash_index)
+    key = '\n'.join([checksum, partials.code_version(ingest_station), repr(fields)])
+    return os.path.join(store_dir, hashlib.sha256(key.encode()).hexdigest() + '.npz')
+
+def ingest_to_store(file_path, store_dir, fields, hash_index=None, chunksize=None):
+    """
+    Ingests a station CSV file into the shared store unless it is already there.
+
+    Args:
+        file_path (str): Path to the LCD CSV file.
+        store_dir (str): Directory of the shared store.
+        fields (list of str): Fields to keep.
+        hash_index (dict, optional): Index of previously computed checksums, updated in place.
+        chunksize (int, optional): Stream the file in chunks of this many rows.
+
+    Returns:
+        str: Path of the ingested .npz file in the store.
+    """
+    store_path = stored_path(file_path, store_dir, fields, hash_index)
+    if not os.path.isfile(store_path):
+        # Write atomically, as concurrent runs may share the store
+        temp_path = '{}.{}.tmp.npz'.format(store_path[:-4], os.getpid())
+        ingest_station(file_path, temp_path, fields, chunksize)
+        os.replace(temp_path, store_path)
+    return store_path
+
+if __name__ == "__main__":
+    # Define input parameters
+    folder_path = 'data'
+    output_folder = 'intermediate'
+    store_dir = 'outputs/partials/ingest'
+    all_daily_avg_fields = ['DailyAverageDryBulbTemperature', 
+                            'DailyMaximumDryBulbTemperature', 
+                            'DailyMinimumDryBulbTemperature',
+                            'DailyAverageSeaLevelPressure',
+                            'DailyAverageStationPressure']
+    all_monthly_avg_fields = ['MonthlyMeanTemperature', 
+                              'MonthlyMaximumTemperature', 
+                              'MonthlyMinimumTemperature',
+                              'MonthlySeaLevelPressure', 
+                              'MonthlyStationPressure']
+
+    # Read the year of the stations, the extraction settings and the profiling switch from the YAML file
+    with open('params/params.yaml', 'r') as file:
+        params = yaml.safe_load(file)
+    year = params['download']['year']
+    chunksize = params['extract']['chunksize']
+    use_cube = params['extract']['cube']
+    profile = params['metrics']['profile']
+
+    with metrics.stage_metrics('ingest', profile=profile) as counters:
+        # Parse every station file once into the columnar intermediate, keeping the hourly
+        # sources of the daily fields for stations without daily summaries. Stations already in
+        # the persistent store are copied from it instead of being parsed again
+        output_paths = ingest_folder(folder_path, output_folder, all_daily_avg_fields + all_monthly_avg_fields
+                                     + lcd.hourly_fields(all_daily_avg_fields), counters, store_dir, chunksize)
+
+        # Lay all stations into the day-of-year aligned cube, only read by prepare.py and process.py with extract.cube
+        if use_cube:
+            cube.build_cube(output_paths, os.path.join(output_folder, 'cube.npy'),
+                            all_daily_avg_fields + all_monthly_avg_fields, year, chunksize=chunksize)
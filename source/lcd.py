@@ -0,0 +1,375 @@
+import os
+import zipfile
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import numpy as np
+import pandas as pd
+
+# Leading number of a value, which drops LCD quality flags such as the 's' (suspect) suffix or '*'
+NUMBER_PATTERN = r'^\s*([-+]?(?:\d+\.?\d*|\.\d+))'
+
+# Hourly field and aggregation each daily summary field can be derived from
+HOURLY_SOURCES = {'DailyAverageDryBulbTemperature': ('HourlyDryBulbTemperature', 'mean'),
+                  'DailyMaximumDryBulbTemperature': ('HourlyDryBulbTemperature', 'max'),
+                  'DailyMinimumDryBulbTemperature': ('HourlyDryBulbTemperature', 'min'),
+                  'DailyAverageSeaLevelPressure': ('HourlySeaLevelPressure', 'mean'),
+                  'DailyAverageStationPressure': ('HourlyStationPressure', 'mean')}
+
+def clean_numeric(column, dtype='float64'):
+    """
+    Converts an LCD column into a float array, stripping quality flags from its values.
+
+    Columns which the CSV parser already read as numbers are converted directly. Only
+    columns holding flagged values are cleaned with vectorized string operations, and
+    values without a number (such as 'T' or 'M') become NaN.
+
+    Args:
+        column (pandas.Series): Column as read from the CSV file.
+        dtype (str): Float dtype of the returned array.
+
+    Returns:
+        numpy.ndarray: The column values as floats.
+    """
+    if column.dtype != object:
+        return column.to_numpy(dtype=dtype)
+    return column.str.extract(NUMBER_PATTERN, expand=False).astype('float').to_numpy(dtype=dtype)
+
+def frame_to_arrays(df, fields, dtype='float64'):
+    """
+    Converts a frame of raw LCD columns into date and value arrays.
+
+    Args:
+        df (pandas.DataFrame): Frame holding DATE and (some of) the requested fields.
+        fields (list of str): Fields to convert.
+        dtype (str): Float dtype of the returned values (float64 or float32).
+
+    Returns:
+        tuple: An array of the dates (datetime64) and a 2D array of the field values with
+        one column per field.
+    """
+    dates = pd.to_datetime(df['DATE'], format='ISO8601').to_numpy()
+
+    # Clean each field into its column of the value array
+    values = np.full((len(df), len(fields)), np.nan, dtype=dtype)
+    for i, field in enumerate(fields):
+        if field in df:
+            values[:, i] = clean_numeric(df[field], dtype)
+    return dates, values
+
+def read_lcd(file_path, fields, dtype='float64'):
+    """
+    Reads the DATE column and the requested fields of an LCD file.
+
+    Only the requested columns are parsed. Fields missing from the file are returned as NaN.
+
+    Args:
+        file_path (str): Path to the LCD CSV file.
+        fields (list of str): Fields to read.
+        dtype (str): Float dtype of the returned values (float64 or float32).
+
+    Returns:
+        tuple: An array of the dates (datetime64) and a 2D array of the field values with
+        one column per field.
+    """
+    if not isinstance(fields, list):
+        raise TypeError("fields must be a list")
+
+    # Read DATE and the requested fields only
+    wanted = set(fields) | {'DATE'}
+    df = pd.read_csv(file_path, usecols=lambda column: column in wanted, dtype={'DATE': str}, low_memory=False)
+    return frame_to_arrays(df, fields, dtype)
+
+def iter_lcd_chunks(file_path, fields, chunksize, dtype='float64'):
+    """
+    Reads the DATE column and the requested fields of an LCD file in chunks of rows.
+
+    Memory use is bounded by the chunk size, however large the file is.
+
+    Args:
+        file_path (str): Path to the LCD CSV file.
+        fields (list of str): Fields to read.
+        chunksize (int): Number of rows per chunk.
+        dtype (str): Float dtype of the returned values (float64 or float32).
+
+    Yields:
+        tuple: An array of the dates (datetime64) and a 2D array of the field values of each chunk.
+    """
+    if not isinstance(fields, list):
+        raise TypeError("fields must be a list")
+    if not isinstance(chunksize, int) or chunksize <= 0:
+        raise ValueError("chunksize must be a positive integer.")
+
+    wanted = set(fields) | {'DATE'}
+    with pd.read_csv(file_path, usecols=lambda column: column in wanted, dtype={'DATE': str},
+                     chunksize=chunksize) as reader:
+        for df in reader:
+            yield frame_to_arrays(df, fields, dtype)
+
+def write_station(file_path, dates, values, fields):
+    """
+    Writes the parsed data of a station to a compressed columnar .npz file.
+
+    Args:
+        file_path (str): Path of the .npz file to write.
+        dates (numpy.ndarray): Array of datetime64 values.
+        values (numpy.ndarray): 2D array of field values with one column per field.
+        fields (list of str): Names of the value columns.
+    """
+    np.savez_compressed(file_path, dates=dates, values=values, fields=np.array(fields))
+
+def write_station_chunks(file_path, chunks, fields):
+    """
+    Writes a station given in chunks of rows to a compressed columnar .npz file.
+
+    The chunks are appended to temporary files which are memory-mapped when the station is
+    complete, and np.savez_compressed writes the mapped arrays in buffered pieces, so memory
+    use is bounded by the chunk size however large the station is.
+
+    Args:
+        file_path (str): Path of the .npz file to write.
+        chunks (iterable): Tuples of an array of the dates (datetime64) and a 2D array of the
+            field values of each chunk, as yielded by iter_lcd_chunks.
+        fields (list of str): Names of the value columns.
+
+    Returns:
+        int: Number of rows of the station.
+    """
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(file_path))) as temp_dir:
+        dates_path = os.path.join(temp_dir, 'dates')
+        values_path = os.path.join(temp_dir, 'values')
+        n_rows = 0
+        dates_dtype, values_dtype = np.dtype('datetime64[ns]'), np.dtype('float64')
+        with open(dates_path, 'wb') as dates_file, open(values_path, 'wb') as values_file:
+            for dates, values in chunks:
+                dates_file.write(dates.tobytes())
+                values_file.write(np.ascontiguousarray(values).tobytes())
+                n_rows += len(dates)
+                dates_dtype, values_dtype = dates.dtype, values.dtype
+
+        # Map the complete columns, an empty file cannot be mapped
+        if n_rows == 0:
+            dates = np.empty(0, dtype=dates_dtype)
+            values = np.empty((0, len(fields)), dtype=values_dtype)
+        else:
+            dates = np.memmap(dates_path, dtype=dates_dtype, mode='r', shape=(n_rows,))
+            values = np.memmap(values_path, dtype=values_dtype, mode='r', shape=(n_rows, len(fields)))
+        write_station(file_path, dates, values, fields)
+        del dates, values
+    return n_rows
+
+def select_columns(stored_values, stored_fields, fields, dtype='float64'):
+    """
+    Selects the requested fields from the value columns of an ingested station.
+
+    Args:
+        stored_values (numpy.ndarray): 2D array of the stored values with one column per stored field.
+        stored_fields (list of str): Names of the stored columns.
+        fields (list of str): Fields to select.
+        dtype (str): Float dtype of the returned values (float64 or float32).
+
+    Returns:
+        numpy.ndarray: 2D array with one column per requested field, NaN for fields which
+        were not ingested.
+    """
+    values = np.full((len(stored_values), len(fields)), np.nan, dtype=dtype)
+    for i, field in enumerate(fields):
+        if field in stored_fields:
+            values[:, i] = stored_values[:, stored_fields.index(field)]
+    return values
+
+def read_station(file_path, fields, dtype='float64'):
+    """
+    Reads the dates and the requested fields of a station from an LCD CSV file or an ingested .npz file.
+
+    Args:
+        file_path (str): Path to the .csv or .npz file.
+        fields (list of str): Fields to read.
+        dtype (str): Float dtype of the returned values (float64 or float32).
+
+    Returns:
+        tuple: An array of the dates (datetime64) and a 2D array of the field values with
+        one column per field.
+    """
+    if not file_path.endswith('.npz'):
+        return read_lcd(file_path, fields, dtype)
+
+    with np.load(file_path) as station:
+        dates = station['dates']
+        stored_fields = list(station['fields'])
+        stored_values = station['values']
+    return dates, select_columns(stored_values, stored_fields, fields, dtype)
+
+def read_npy_header(member):
+    """
+    Reads the header of an array stored in .npy format, leaving the file at the start of the data.
+
+    Args:
+        member (file): The opened .npy file or .npz member.
+
+    Returns:
+        tuple: The shape, whether the array is in Fortran order, and the dtype.
+    """
+    version = np.lib.format.read_magic(member)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(member)
+    return np.lib.format.read_array_header_2_0(member)
+
+def station_rows(file_path):
+    """
+    Counts the rows of an ingested .npz station without reading its arrays.
+
+    Args:
+        file_path (str): Path to the .npz file.
+
+    Returns:
+        int: Number of rows of the station.
+    """
+    with zipfile.ZipFile(file_path) as archive, archive.open('dates.npy') as member:
+        return read_npy_header(member)[0][0]
+
+def iter_npz_rows(archive, name, chunksize):
+    """
+    Reads an array stored in an .npz archive in chunks of rows.
+
+    The member is decompressed as a stream, so only one chunk is held in memory at a time.
+
+    Args:
+        archive (zipfile.ZipFile): The opened .npz file.
+        name (str): Name of the array.
+        chunksize (int): Number of rows per chunk.
+
+    Yields:
+        numpy.ndarray: The rows of each chunk.
+    """
+    with archive.open(name + '.npy') as member:
+        shape, fortran_order, dtype = read_npy_header(member)
+        if fortran_order and len(shape) > 1:
+            raise ValueError("Cannot stream the Fortran ordered array {}".format(name))
+
+        row_shape = shape[1:]
+        row_bytes = dtype.itemsize * int(np.prod(row_shape))
+        for start in range(0, shape[0], chunksize):
+            n_rows = min(chunksize, shape[0] - start)
+            yield np.frombuffer(member.read(n_rows * row_bytes), dtype=dtype).reshape((n_rows,) + row_shape)
+
+def iter_station_chunks(file_path, fields, chunksize, dtype='float64'):
+    """
+    Reads a station from an LCD CSV file or an ingested .npz file in chunks of rows.
+
+    Memory use is bounded by the chunk size for both kinds of files.
+
+    Args:
+        file_path (str): Path to the .csv or .npz file.
+        fields (list of str): Fields to read.
+        chunksize (int): Number of rows per chunk.
+        dtype (str): Float dtype of the returned values (float64 or float32).
+
+    Yields:
+        tuple: An array of the dates (datetime64) and a 2D array of the field values of each chunk.
+    """
+    if not file_path.endswith('.npz'):
+        yield from iter_lcd_chunks(file_path, fields, chunksize, dtype)
+        return
+    if not isinstance(chunksize, int) or chunksize <= 0:
+        raise ValueError("chunksize must be a positive integer.")
+
+    with np.load(file_path) as station:
+        stored_fields = list(station['fields'])
+    with zipfile.ZipFile(file_path) as archive:
+        for dates, stored_values in zip(iter_npz_rows(archive, 'dates', chunksize),
+                                        iter_npz_rows(archive, 'values', chunksize)):
+            yield dates, select_columns(stored_values, stored_fields, fields, dtype)
+
+def list_stations(folder_path):
+    """
+    Lists the station files (LCD .csv or ingested .npz) of a folder in sorted order.
+
+    Args:
+        folder_path (str): Path to the folder containing station files.
+
+    Returns:
+        list of str: Sorted file names of the stations.
+    """
+    return [file_name for file_name in sorted(os.listdir(folder_path)) if file_name.endswith(('.csv', '.npz'))]
+
+def map_stations(function, file_paths, args, workers=1):
+    """
+    Applies a per-station function to every station file, optionally over a process pool.
+
+    Results are returned in the order of file_paths, so a parallel run produces exactly the
+    same results as a serial one.
+
+    Args:
+        function (callable): Module level function taking a file path followed by args.
+        file_paths (list of str): Paths of the station files.
+        args (tuple): Further arguments passed on to the function, such as the fields.
+        workers (int): Number of worker processes, 1 to run serially in this process.
+
+    Returns:
+        list: Result of the function for each station file.
+    """
+    if not isinstance(workers, int) or workers <= 0:
+        raise ValueError("workers must be a positive integer.")
+
+    if workers == 1 or len(file_paths) <= 1:
+        return [function(file_path, *args) for file_path in file_paths]
+    chunksize = max(1, len(file_paths) // (4 * workers))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(function, file_paths, *[repeat(arg) for arg in args], chunksize=chunksize))
+
+def month_numbers(dates):
+    """
+    Computes the month (1-12) of each date.
+
+    Args:
+        dates (numpy.ndarray): Array of datetime64 values.
+
+    Returns:
+        numpy.ndarray: Month of each date.
+    """
+    return dates.astype('datetime64[M]').astype(int) % 12 + 1
+
+def hourly_fields(daily_fields):
+    """
+    Lists the hourly fields the given daily fields can be derived from.
+
+    Args:
+        daily_fields (list of str): Daily summary fields.
+
+    Returns:
+        list of str: Hourly source fields, in the order they are first needed.
+    """
+    return list(dict.fromkeys(HOURLY_SOURCES[field][0] for field in daily_fields if field in HOURLY_SOURCES))
+
+def daily_from_hourly(dates, hourly_values, hourly_field_names, daily_fields):
+    """
+    Derives daily summary fields from hourly observations.
+
+    All fields are aggregated in one groupby over the calendar day of the rows, taking the
+    mean, maximum or minimum of the hourly source of each daily field. Days without any
+    hourly value of a source are NaN.
+
+    Args:
+        dates (numpy.ndarray): Array of datetime64 values of the rows.
+        hourly_values (numpy.ndarray): 2D float array with one column per hourly field.
+        hourly_field_names (list of str): Names of the hourly columns.
+        daily_fields (list of str): Daily fields to derive.
+
+    Returns:
+        tuple: An array of the days (datetime64) and a 2D array with one column per daily
+        field, NaN for fields without an hourly source.
+    """
+    sources = {field: HOURLY_SOURCES[field] for field in daily_fields
+               if field in HOURLY_SOURCES and HOURLY_SOURCES[field][0] in hourly_field_names}
+    if len(dates) == 0 or not sources:
+        return dates[:0].astype('datetime64[D]'), np.full((0, len(daily_fields)), np.nan)
+
+    frame = pd.DataFrame(hourly_values, index=pd.DatetimeIndex(dates), columns=hourly_field_names)
+    daily = frame.groupby(frame.index.floor('D')).agg(**sources)
+
+    values = np.full((len(daily), len(daily_fields)), np.nan)
+    for i, field in enumerate(daily_fields):
+        if field in sources:
+            values[:, i] = daily[field].to_numpy(dtype='float64')
+    return daily.index.to_numpy().astype('datetime64[D]'), values
@@ -0,0 +1,70 @@
+import os
+import sys
+import json
+import time
+import cProfile
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+def peak_rss_mb(who):
+    """
+    Returns the peak resident set size of this process or of its waited-for children.
+
+    Args:
+        who (int): resource.RUSAGE_SELF or resource.RUSAGE_CHILDREN.
+
+    Returns:
+        float or None: Peak RSS in MB, None where the platform does not report it.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return round(peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10, 2)
+
+@contextmanager
+def stage_metrics(stage, metrics_dir='metrics', profile=False):
+    """
+    Records the performance of a pipeline stage in metrics_dir/<stage>.json, to be compared with dvc metrics.
+
+    Wall time, CPU time (including worker processes) and peak RSS are measured around the
+    block, and the stage adds its own counters, such as the files, rows and bytes it
+    processed, to the yielded dict. With profile, a cProfile dump of the block is written
+    to metrics_dir/<stage>.prof (view it with python -m pstats or snakeviz). The metrics
+    are only written if the block succeeds.
+
+    Args:
+        stage (str): Name of the stage.
+        metrics_dir (str, optional): Directory to write the metrics to.
+        profile (bool, optional): Whether to profile the stage with cProfile.
+
+    Yields:
+        dict: Counters of the stage, filled in by the block.
+    """
+    counters = {}
+    os.makedirs(metrics_dir, exist_ok=True)
+    profiler = cProfile.Profile() if profile else None
+    start_wall = time.perf_counter()
+    start_cpu = os.times()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield counters
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(metrics_dir, stage + '.prof'))
+
+    end_cpu = os.times()
+    cpu_time = sum(end - start for end, start in zip(end_cpu[:4], start_cpu[:4]))
+    values = {'wall_time_s': round(time.perf_counter() - start_wall, 4),
+              'cpu_time_s': round(cpu_time, 4),
+              'peak_rss_mb': peak_rss_mb(resource.RUSAGE_SELF) if resource else None,
+              'children_peak_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN) if resource else None}
+    values.update(counters)
+    with open(os.path.join(metrics_dir, stage + '.json'), 'w') as file:
+        json.dump(values, file, indent=4)
@@ -0,0 +1,137 @@
+import os
+import sys
+import json
+import hashlib
+import numpy as np
+import lcd
+
+def file_sha256(file_path):
+    """
+    Computes the SHA-256 checksum of a file.
+
+    Args:
+        file_path (str): Path to the file.
+
+    Returns:
+        str: Hex digest of the file contents.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def code_version(function):
+    """
+    Computes a checksum of the code a per-station function depends on.
+
+    The function's own module and the shared reader are hashed, so that editing either of
+    them invalidates the partial results computed with the old code.
+
+    Args:
+        function (callable): Per-station function.
+
+    Returns:
+        str: Hex digest identifying the code version.
+    """
+    digest = hashlib.sha256()
+    for module in (sys.modules[function.__module__], lcd):
+        with open(module.__file__, 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+def load_hash_index(index_path):
+    """
+    Loads the index of previously computed file checksums.
+
+    Args:
+        index_path (str): Path to the JSON index.
+
+    Returns:
+        dict: Mapping from file path to its size, modification time and checksum.
+    """
+    if not os.path.isfile(index_path):
+        return {}
+    with open(index_path, 'r') as file:
+        return json.load(file)
+
+def save_hash_index(index_path, hash_index):
+    """
+    Writes the index of file checksums through a process specific temporary file.
+
+    Args:
+        index_path (str): Path to the JSON index.
+        hash_index (dict): Mapping from file path to its size, modification time and checksum.
+    """
+    temp_path = '{}.{}.tmp'.format(index_path, os.getpid())
+    with open(temp_path, 'w') as file:
+        json.dump(hash_index, file)
+    os.replace(temp_path, index_path)
+
+def cached_sha256(file_path, hash_index):
+    """
+    Returns the checksum of a file, reading the file only if it changed since it was last hashed.
+
+    Args:
+        file_path (str): Path to the file.
+        hash_index (dict): Index of previously computed checksums, updated in place.
+
+    Returns:
+        str: Hex digest of the file contents.
+    """
+    stat = os.stat(file_path)
+    entry = hash_index.get(file_path)
+    if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+        entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': file_sha256(file_path)}
+        hash_index[file_path] = entry
+    return entry['sha256']
+
+def map_stations_memoized(function, file_paths, args, partials_dir, workers=1):
+    """
+    Applies a per-station function to every station file, reusing partial results of earlier runs.
+
+    Each result is stored under partials_dir, keyed by the content hash of the station file,
+    the arguments (such as the fields) and the version of the code computing it. Only
+    stations without a stored result are computed, so adding stations costs time
+    proportional to the new stations.
+
+    Args:
+        function (callable): Module level function taking a file path followed by args, and
+            returning a tuple of numpy arrays.
+        file_paths (list of str): Paths of the station files.
+        args (tuple): Further arguments passed on to the function, such as the fields.
+        partials_dir (str): Directory holding the partial results.
+        workers (int): Number of worker processes for the stations to compute.
+
+    Returns:
+        list: Result of the function for each station file, in the order of file_paths.
+    """
+    os.makedirs(partials_dir, exist_ok=True)
+    index_path = os.path.join(partials_dir, 'hashes.json')
+    hash_index = load_hash_index(index_path)
+
+    # Key every station by its contents, the arguments and the code version
+    version = code_version(function)
+    keys = []
+    for file_path in file_paths:
+        key = hashlib.sha256('\n'.join([cached_sha256(file_path, hash_index), version, repr(args)]).encode())
+        keys.append(os.path.join(partials_dir, key.hexdigest() + '.npz'))
+
+    # Compute the stations which have no partial result yet
+    missing = [i for i, key in enumerate(keys) if not os.path.isfile(key)]
+    computed = lcd.map_stations(function, [file_paths[i] for i in missing], args, workers)
+    # Write through process specific temporary files, as concurrent runs may share partials_dir
+    for i, result in zip(missing, computed):
+        temp_path = '{}.{}.tmp.npz'.format(keys[i], os.getpid())
+        np.savez(temp_path, *result)
+        os.replace(temp_path, keys[i])
+
+    save_hash_index(index_path, hash_index)
+
+    # Merge the partial results in station order
+    results = dict(zip(missing, computed))
+    for i, key in enumerate(keys):
+        if i not in results:
+            with np.load(key) as partial:
+                results[i] = tuple(partial['arr_{}'.format(j)] for j in range(len(partial.files)))
+    return [results[i] for i in range(len(keys))]
@@ -0,0 +1,125 @@
+import os
+import yaml
+import shutil
+import numpy as np
+import lcd
+import download
+import ingest
+import prepare
+import process
+import evaluate
+import tables
+
+def run_stages(intermediate_dir, outputs_dir, daily_avg_fields, monthly_avg_fields, partials_dir=None, workers=1,
+               chunksize=None):
+    """
+    Runs the prepare, process and evaluate stages in one process, handing their results over in memory.
+
+    The monthly averages of prepare and process go straight into the R-squared computation,
+    and the CSV artifacts are only written at the end, with the same contents as the
+    per-stage scripts produce.
+
+    Args:
+        intermediate_dir (str): Folder holding the ingested stations.
+        outputs_dir (str): Folder to write the outputs to.
+        daily_avg_fields (list of str): Daily fields to average per month.
+        monthly_avg_fields (list of str): Monthly fields to extract.
+        partials_dir (str, optional): Directory to memoize per-station results in.
+        workers (int, optional): Number of worker processes for the stations.
+        chunksize (int, optional): Stream each station file in chunks of this many rows.
+
+    Returns:
+        tuple: The locations, the field names and the R-squared values of each location.
+    """
+    prepare_partials = os.path.join(partials_dir, 'prepare') if partials_dir is not None else None
+    process_partials = os.path.join(partials_dir, 'process') if partials_dir is not None else None
+
+    # Ground truth and estimated monthly averages
+    gt_averages, locations = prepare.extract_monthly_averages(intermediate_dir, monthly_avg_fields, workers,
+                                                              prepare_partials, chunksize)
+    est_averages, locations = process.extract_monthly_averages(intermediate_dir, daily_avg_fields, workers,
+                                                               process_partials, chunksize)
+
+    # Evaluate the in-memory estimates against the ground truth
+    field_names = list(gt_averages[0].keys())
+    monthly_avg_gt = tables.monthly_table(gt_averages)
+    monthly_avg_est = tables.monthly_table(est_averages)
+    r2 = evaluate.r2_matrix(monthly_avg_gt, monthly_avg_est)
+    r2_values = r2.tolist()
+
+    # Write the artifacts of every stage
+    os.makedirs(outputs_dir, exist_ok=True)
+    with open(os.path.join(outputs_dir, 'daily_fields_list.txt'), 'w') as text_file:
+        for field in daily_avg_fields:
+            text_file.write(field + '\n')
+    prepare.create_csv_from_dict(gt_averages, locations, os.path.join(outputs_dir, 'prepare_output.csv'))
+    process.create_csv_from_dict(est_averages, locations, os.path.join(outputs_dir, 'process_output.csv'))
+    tables.write_table(os.path.join(outputs_dir, 'prepare_output.npz'), locations, field_names, monthly_avg_gt)
+    tables.write_table(os.path.join(outputs_dir, 'process_output.npz'), locations, list(est_averages[0].keys()),
+                       monthly_avg_est)
+    tables.write_table(os.path.join(outputs_dir, 'evaluate_output.npz'), locations, field_names, r2)
+    evaluate.convert_to_csv(os.path.join(outputs_dir, 'evaluate_output.csv'), r2_values, field_names,
+                            np.array(locations, dtype=object))
+    return locations, field_names, r2_values
+
+def run_pipeline(base_url, params, daily_avg_fields, monthly_avg_fields, data_dir='data',
+                 intermediate_dir='intermediate', outputs_dir='outputs', fetch_data=True):
+    """
+    Runs the whole pipeline in a single warm process.
+
+    The stage folders are cleared first, as dvc does for the stage scripts, so that no
+    stations of an earlier run are left over. data_dir is only cleared when the stations
+    are downloaded.
+
+    Args:
+        base_url (str): Base URL for downloading files.
+        params (dict): Contents of params.yaml.
+        daily_avg_fields (list of str): Daily fields to average per month.
+        monthly_avg_fields (list of str): Monthly fields to extract.
+        data_dir (str, optional): Folder for the downloaded station files.
+        intermediate_dir (str, optional): Folder for the ingested stations.
+        outputs_dir (str, optional): Folder for the outputs.
+        fetch_data (bool, optional): Download the stations, or use the files already in data_dir.
+
+    Returns:
+        tuple: The locations, the field names and the R-squared values of each location.
+    """
+    # Start from empty stage folders
+    shutil.rmtree(intermediate_dir, ignore_errors=True)
+    if fetch_data:
+        shutil.rmtree(data_dir, ignore_errors=True)
+        download_params = params['download']
+        download.download_csv(base_url, download_params['year'], download_params['n_locs'], download_params['seed'],
+                              download_params['workers'], data_dir, download_params['cache_dir'],
+                              download_params['timeout'], download_params['retries'],
+                              download_params['min_size'], download_params['max_size'])
+
+    # Parse every new station file once
+    extract_params = params['extract']
+    ingest.ingest_folder(data_dir, intermediate_dir, daily_avg_fields + monthly_avg_fields
+                         + lcd.hourly_fields(daily_avg_fields), store_dir=os.path.join(outputs_dir, 'partials', 'ingest'),
+                         chunksize=extract_params['chunksize'])
+
+    return run_stages(intermediate_dir, outputs_dir, daily_avg_fields, monthly_avg_fields,
+                      os.path.join(outputs_dir, 'partials'), extract_params['workers'], extract_params['chunksize'])
+
+if __name__ == "__main__":
+    # Define base url
+    base_url = 'https://www.ncei.noaa.gov/data/local-climatological-data/'
+    # Read YAML file
+    with open('params/params.yaml', 'r') as file:
+        params = yaml.safe_load(file)
+
+    all_daily_avg_fields = ['DailyAverageDryBulbTemperature', 
+                            'DailyMaximumDryBulbTemperature', 
+                            'DailyMinimumDryBulbTemperature',
+                            'DailyAverageSeaLevelPressure',
+                            'DailyAverageStationPressure']
+    all_monthly_avg_fields = ['MonthlyMeanTemperature', 
+                              'MonthlyMaximumTemperature', 
+                              'MonthlyMinimumTemperature',
+                              'MonthlySeaLevelPressure', 
+                              'MonthlyStationPressure']
+
+    # Run all stages in this process
+    run_pipeline(base_url, params, all_daily_avg_fields, all_monthly_avg_fields)
@@ -1,76 +1,141 @@
 import os
 import csv
-import pandas as pd
+import yaml
 import numpy as np
+import lcd
+import cube
+import metrics
+import partials
+import tables
 
-def extract_monthly_averages(folder_path, monthly_avg_fields):
+def monthly_last_values(months, values):
+    """
+    Finds the last non-empty value of every field for each month in a single pass over the rows.
+
+    Args:
+    - months (numpy.ndarray): Month (1-12) of each row.
+    - values (numpy.ndarray): 2D float array with one column per field.
+
+    Returns:
+    - numpy.ndarray: 12 x F array of the last values, NaN where a month has no values.
+    """
+    if len(values) == 0:
+        return np.full((12, values.shape[1]), np.nan)
+
+    # Sort rows by month while keeping their original order within each month
+    order = np.argsort(months, kind='stable')
+    values = values[order]
+    bounds = np.searchsorted(months[order], np.arange(1, 14))
+
+    # Position of the latest non-empty value at or before each row
+    positions = np.where(np.isnan(values), -1, np.arange(len(values))[:, None])
+    latest = np.maximum.accumulate(positions, axis=0)
+
+    # Look up the latest non-empty position at the end of each month
+    ends = np.maximum(bounds[1:] - 1, 0)
+    last = latest[ends]
+    found = (last >= bounds[:-1, None]) & (bounds[1:] > bounds[:-1])[:, None]
+    return np.where(found, values[np.where(found, last, 0), np.arange(values.shape[1])], np.nan)
+
+def station_monthly_values(file_path, monthly_avg_fields, chunksize=None):
+    """
+    Extracts the last non-empty value of each month for specified fields from a single station file.
+
+    With a chunksize, the file is streamed in chunks of rows and only the last value seen
+    for each month is kept, so memory stays bounded however large the file is.
+
+    Args:
+    - file_path (str): Path to the station file (LCD .csv or ingested .npz).
+    - monthly_avg_fields (list of str): List of field names to extract.
+    - chunksize (int, optional): Number of rows per chunk, None to read the whole file at once.
+
+    Returns:
+    - monthly_values (numpy.ndarray): 12 x F array of the monthly values.
+    - has_values (numpy.ndarray): Boolean array telling which fields contain at least one non-empty value.
+    """
+    if chunksize is None:
+        # Read the date and the required fields, with quality flags stripped
+        dates, values = lcd.read_station(file_path, monthly_avg_fields)
+        
+        # Extract the last non-NaN value of every field for each month
+        return monthly_last_values(lcd.month_numbers(dates), values), ~np.isnan(values).all(axis=0)
+
+    # Keep the last value seen for each month, chunk by chunk
+    monthly_values = np.full((12, len(monthly_avg_fields)), np.nan)
+    for dates, values in lcd.iter_station_chunks(file_path, monthly_avg_fields, chunksize):
+        chunk_values = monthly_last_values(lcd.month_numbers(dates), values)
+        monthly_values = np.where(np.isnan(chunk_values), monthly_values, chunk_values)
+    return monthly_values, ~np.isnan(monthly_values).all(axis=0)
+
+def extract_monthly_averages(folder_path, monthly_avg_fields, workers=1, partials_dir=None, chunksize=None):
     """
     Extracts monthly averages for specified fields from CSV files in the given folder path.
 
     Args:
-    - folder_path (str): Path to the folder containing CSV files.
+    - folder_path (str): Path to the folder containing station files (LCD .csv or ingested .npz).
     - monthly_avg_fields (list of str): List of field names for which monthly averages are to be extracted.
+    - workers (int): Number of worker processes to spread the stations over, 1 to run serially.
+    - partials_dir (str, optional): Directory to memoize per-station results in, so that only new or changed stations are computed.
+    - chunksize (int, optional): Stream each station file in chunks of this many rows to bound memory use.
 
     Returns:
     - monthly_averages_list (list of dict): List of dictionaries containing monthly averages for each field.
     - locations (list of str): List of location names extracted from file names.
     """
-    monthly_averages_list = []  # List to store monthly averages for each CSV file
-    locations = []  # List to store location names extracted from file names
+    monthly_averages_list = []  # List to store monthly averages for each station file
+    file_names = lcd.list_stations(folder_path)
+    locations = [os.path.splitext(file_name)[0] for file_name in file_names]  # Extract location names
     
-    # Iterate through each CSV file in the folder
-    for file_name in sorted(os.listdir(folder_path)):
-        if file_name.endswith('.csv'):
-            file_path = os.path.join(folder_path, file_name)
-            locations.append(file_name[:-4])  # Extract location name from file name
-            
-            # Read the CSV file into a DataFrame
-            df = pd.read_csv(file_path, low_memory=False)
-
-            # Define the regex pattern to match any number followed by 's'
-            pattern = r'(\d+)s'
-
-            # Apply regex substitution to all columns in the DataFrame
-            df = df.replace(regex={pattern: r'\1'})
-            
-            # Extract month from date column
-            df['MONTH'] = df['DATE'].apply(lambda date: int(date.split('-')[1]))
-            
-            # Initialize a dictionary to store monthly averages for the current CSV file
-            monthly_averages = {field: [] for field in monthly_avg_fields}
-            
-            # Iterate through each field in monthly_avg_fields
-            for field in monthly_avg_fields:
-                # Check if the field exists and contains at least one non-empty value
-                if not df[field].isnull().all():
-                    # Extract the monthly average for each month
-                    for month in range(1, 13):
-                        # Check if data exists for the current month
-                        if any(df['MONTH'] == month):
-                            # Extract the last value for the current month
-                            monthly_data = df[df['MONTH'] == month][field].dropna().astype('float')
-                            if not monthly_data.empty:
-                                monthly_avg = monthly_data.iloc[-1]  # Extract last non-NaN value
-                            else:
-                                monthly_avg = np.nan  # All values are NaN for this month
-                        else:
-                            # No data exists for the current month, append NaN
-                            monthly_avg = np.nan
-                        # Append the monthly average to the corresponding field in monthly_averages dictionary
-                        monthly_averages[field].append(monthly_avg)
-                        
-            # Append the dictionary containing monthly averages for the current CSV file to the list
-            monthly_averages_list.append(monthly_averages)
+    # Extract the monthly values of each station file (LCD .csv or ingested .npz), in sorted file order
+    file_paths = [os.path.join(folder_path, file_name) for file_name in file_names]
+    if partials_dir is None:
+        results = lcd.map_stations(station_monthly_values, file_paths, (monthly_avg_fields, chunksize), workers)
+    else:
+        results = partials.map_stations_memoized(station_monthly_values, file_paths, (monthly_avg_fields, chunksize),
+                                                 partials_dir, workers)
+    
+    for monthly_values, has_values in results:
+        # Store the monthly values of fields which contain at least one non-empty value
+        monthly_averages = {field: list(monthly_values[:, i]) if has_values[i] else []
+                            for i, field in enumerate(monthly_avg_fields)}
+        monthly_averages_list.append(monthly_averages)
     
     return monthly_averages_list, locations
 
-def create_csv_from_dict(data_list, locations):
+def extract_monthly_averages_from_cube(cube_path, monthly_avg_fields):
+    """
+    Extracts the last non-empty value of each month for specified fields of all stations from the data cube.
+
+    The reduction runs over all stations in one vectorized call. Values are taken from the
+    float32 cube, so they may differ from extract_monthly_averages in the last digits.
+
+    Args:
+    - cube_path (str): Path to the cube written by the ingest stage.
+    - monthly_avg_fields (list of str): List of field names to extract.
+
+    Returns:
+    - monthly_averages_list (list of dict): List of dictionaries containing monthly averages for each field.
+    - locations (list of str): List of location names.
+    """
+    data, meta = cube.open_cube(cube_path)
+    values = cube.select_fields(data, meta, monthly_avg_fields)
+    monthly_values = cube.monthly_last(values, meta['year'])
+    has_values = ~np.isnan(values).all(axis=1)
+
+    # Store the monthly values of fields which contain at least one non-empty value
+    monthly_averages_list = [{field: list(monthly_values[station, :, i]) if has_values[station, i] else []
+                              for i, field in enumerate(monthly_avg_fields)}
+                             for station in range(len(meta['stations']))]
+    return monthly_averages_list, meta['stations']
+
+def create_csv_from_dict(data_list, locations, output_file=os.path.join('outputs', 'prepare_output.csv')):
     """
     Creates a CSV file from a list of dictionaries containing monthly averages.
 
     Args:
     - data_list (list of dict): List of dictionaries containing monthly averages for each field.
     - locations (list of str): List of location names corresponding to the data.
+    - output_file (str, optional): Path of the CSV file to write.
 
     Returns:
     - None
@@ -78,9 +143,6 @@ def create_csv_from_dict(data_list, locations):
     # Get the field names from the keys of the dictionary
     field_names = ['Location'] + ['Month'] + list(data_list[0].keys())  # Include 'Location' and 'Month' as the first and second field
     
-    # Define the output file path
-    output_file = os.path.join('outputs', 'prepare_output.csv')
-    
     # Write data to CSV file
     with open(output_file, 'w', newline='') as csvfile:
         writer = csv.DictWriter(csvfile, fieldnames=field_names)
@@ -102,7 +164,17 @@ def create_csv_from_dict(data_list, locations):
 
 if __name__ == "__main__":
     # Define input parameters
-    folder_path = 'data'
+    folder_path = 'intermediate'
+
+    # Read the number of worker processes, the chunk size and the profiling switch from the YAML file
+    with open('params/params.yaml', 'r') as file:
+        all_params = yaml.safe_load(file)
+    params = all_params['extract']
+    profile = all_params['metrics']['profile']
+    workers = params['workers']
+    chunksize = params['chunksize']
+    use_cube = params['cube']
+    partials_dir = 'outputs/partials/prepare'
     all_daily_avg_fields = ['DailyAverageDryBulbTemperature', 
                             'DailyMaximumDryBulbTemperature', 
                             'DailyMinimumDryBulbTemperature',
@@ -120,8 +192,21 @@ if __name__ == "__main__":
         for field in all_daily_avg_fields:
             text_file.write(field + '\n')    
     
-    # Extract monthly averages and location names
-    monthly_averages, locations = extract_monthly_averages(folder_path, all_monthly_avg_fields)
+    with metrics.stage_metrics('prepare', profile=profile) as counters:
+        # Extract monthly averages and location names
+        if use_cube:
+            monthly_averages, locations = extract_monthly_averages_from_cube(os.path.join(folder_path, 'cube.npy'), all_monthly_avg_fields)
+        else:
+            monthly_averages, locations = extract_monthly_averages(folder_path, all_monthly_avg_fields, workers, partials_dir, chunksize)
     
-    # Create CSV from the extracted data
-    create_csv_from_dict(monthly_averages, locations)
+        # Create CSV from the extracted data
+        create_csv_from_dict(monthly_averages, locations)
+        # Write the binary table read by the evaluate stage
+        tables.write_table('outputs/prepare_output.npz', locations, list(monthly_averages[0].keys()),
+                           tables.monthly_table(monthly_averages))
+
+        # Record the stations read and the rows written
+        counters['files'] = len(locations)
+        counters['bytes'] = sum(os.path.getsize(os.path.join(folder_path, file_name))
+                                for file_name in lcd.list_stations(folder_path))
+        counters['rows'] = 12 * len(locations)
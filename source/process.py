@@ -1,71 +1,213 @@
 import os
 import csv
-import pandas as pd
+import yaml
 import numpy as np
+import lcd
+import cube
+import metrics
+import partials
+import tables
 
-def extract_monthly_averages(folder_path, monthly_avg_fields):
+def monthly_sums(months, values):
+    """
+    Computes the sum and the number of non-empty values of every field for each month in a single pass.
+
+    Rows are sorted by month once so that every month is a contiguous slice. Sums are
+    taken over those slices with missing values counted as zero, which reproduces the
+    summation order (and hence the exact results) of pandas' Series.mean.
+
+    Args:
+        months (numpy.ndarray): Month (1-12) of each row.
+        values (numpy.ndarray): 2D float array with one column per field.
+
+    Returns:
+        tuple: 12 x F arrays of the monthly sums and of the monthly counts.
+    """
+    order = np.argsort(months, kind='stable')
+    bounds = np.searchsorted(months[order], np.arange(1, 14))
+    columns = np.ascontiguousarray(values[order].T)
+    present = ~np.isnan(columns)
+    filled = np.where(present, columns, 0.0)
+
+    # Count the non-empty values of each month from a running total
+    cumulative = np.concatenate([np.zeros((len(columns), 1), dtype=int), present.cumsum(axis=1)], axis=1)
+    counts = cumulative[:, bounds[1:]] - cumulative[:, bounds[:-1]]
+    # Sum each month over all fields at once. Every row is contiguous, so NumPy still sums it
+    # pairwise like Series.mean, which np.add.reduceat or a running total would not
+    sums = np.stack([filled[:, start:end].sum(axis=1) for start, end in zip(bounds[:-1], bounds[1:])])
+    return sums, counts.T
+
+def monthly_means(months, values):
+    """
+    Computes the mean of every field for each month in a single pass over the rows.
+
+    Args:
+        months (numpy.ndarray): Month (1-12) of each row.
+        values (numpy.ndarray): 2D float array with one column per field.
+
+    Returns:
+        numpy.ndarray: 12 x F array of monthly means, NaN where a month has no values.
+    """
+    sums, counts = monthly_sums(months, values)
+    with np.errstate(invalid='ignore'):
+        return sums / counts
+
+def station_monthly_values(file_path, monthly_avg_fields, chunksize=None):
+    """
+    Computes the monthly averages for specified fields from a single station file.
+
+    Daily fields without any value in the file are derived from the hourly observations
+    instead (see lcd.daily_from_hourly), so stations which only report hourly data still
+    get monthly averages.
+
+    With a chunksize, the file is streamed in chunks of rows and only running per-month
+    sums and counts are kept, so memory stays bounded however large the file is. The
+    means then match the in-memory ones up to floating point rounding, since the values
+    are summed in a different order. The rows of the last day of a chunk are carried over
+    to the next one, so that every day is resampled from all of its hourly rows.
+
+    Args:
+        file_path (str): Path to the station file (LCD .csv or ingested .npz).
+        monthly_avg_fields (list): List of fields for which monthly averages are to be computed.
+        chunksize (int, optional): Number of rows per chunk, None to read the whole file at once.
+
+    Returns:
+        tuple: A 12 x F array of the monthly averages and a boolean array telling which
+        fields contain at least one non-empty value.
+    """
+    hourly_fields = lcd.hourly_fields(monthly_avg_fields)
+    n_fields = len(monthly_avg_fields)
+
+    if chunksize is None:
+        # Read the date, the required fields and their hourly sources, with quality flags stripped
+        dates, values = lcd.read_station(file_path, monthly_avg_fields + hourly_fields)
+        
+        # Compute the mean of every field for each month
+        sums, counts = monthly_sums(lcd.month_numbers(dates), values[:, :n_fields])
+
+        # Resample the hourly observations to days if a daily field is empty
+        if hourly_fields and (counts.sum(axis=0) == 0).any():
+            days, daily_values = lcd.daily_from_hourly(dates, values[:, n_fields:], hourly_fields, monthly_avg_fields)
+            hourly_sums, hourly_counts = monthly_sums(lcd.month_numbers(days), daily_values)
+        else:
+            hourly_sums, hourly_counts = np.zeros_like(sums), np.zeros_like(counts)
+    else:
+        # Accumulate the monthly sums and counts chunk by chunk
+        sums = np.zeros((12, n_fields))
+        counts = np.zeros((12, n_fields), dtype=int)
+        hourly_sums = np.zeros((12, n_fields))
+        hourly_counts = np.zeros((12, n_fields), dtype=int)
+        pending_dates, pending_values = None, None  # Hourly rows of the last day seen so far
+        for dates, values in lcd.iter_station_chunks(file_path, monthly_avg_fields + hourly_fields, chunksize):
+            chunk_sums, chunk_counts = monthly_sums(lcd.month_numbers(dates), values[:, :n_fields])
+            sums += chunk_sums
+            counts += chunk_counts
+            if not hourly_fields or len(dates) == 0:
+                continue
+
+            # Resample the completed days, keeping the rows of the last day for the next chunk
+            if pending_dates is not None:
+                dates = np.concatenate([pending_dates, dates])
+                values = np.concatenate([pending_values, values])
+            days = dates.astype('datetime64[D]')
+            complete = days < days[-1]
+            pending_dates, pending_values = dates[~complete], values[~complete]
+            day_dates, daily_values = lcd.daily_from_hourly(dates[complete], values[complete, n_fields:],
+                                                            hourly_fields, monthly_avg_fields)
+            chunk_sums, chunk_counts = monthly_sums(lcd.month_numbers(day_dates), daily_values)
+            hourly_sums += chunk_sums
+            hourly_counts += chunk_counts
+
+        if pending_dates is not None:
+            day_dates, daily_values = lcd.daily_from_hourly(pending_dates, pending_values[:, n_fields:],
+                                                            hourly_fields, monthly_avg_fields)
+            chunk_sums, chunk_counts = monthly_sums(lcd.month_numbers(day_dates), daily_values)
+            hourly_sums += chunk_sums
+            hourly_counts += chunk_counts
+
+    # Use the resampled days for the fields without any daily value
+    derived = counts.sum(axis=0) == 0
+    sums[:, derived] = hourly_sums[:, derived]
+    counts[:, derived] = hourly_counts[:, derived]
+    with np.errstate(invalid='ignore'):
+        return sums / counts, counts.sum(axis=0) > 0
+
+def extract_monthly_averages(folder_path, monthly_avg_fields, workers=1, partials_dir=None, chunksize=None):
     """
     Extracts monthly averages for specified fields from CSV files in the given folder.
 
     Args:
-        folder_path (str): Path to the folder containing CSV files.
+        folder_path (str): Path to the folder containing station files (LCD .csv or ingested .npz).
         monthly_avg_fields (list): List of fields for which monthly averages are to be extracted.
+        workers (int): Number of worker processes to spread the stations over, 1 to run serially.
+        partials_dir (str, optional): Directory to memoize per-station results in, so that only new
+            or changed stations are computed.
+        chunksize (int, optional): Stream each station file in chunks of this many rows to bound memory use.
 
     Returns:
         tuple: A tuple containing a list of dictionaries with monthly averages for each field 
         and a list of locations (CSV file names without the ".csv" extension).
     """
-    monthly_averages_list = []  # List to store monthly averages for each CSV file
-    locations = []  # List to store locations (CSV file names without extension)
+    monthly_averages_list = []  # List to store monthly averages for each station file
+    file_names = lcd.list_stations(folder_path)
+    locations = [os.path.splitext(file_name)[0] for file_name in file_names]  # Extract location names
     
-    # Iterate through each CSV file in the folder
-    for file_name in sorted(os.listdir(folder_path)):
-        if file_name.endswith('.csv'):
-            file_path = os.path.join(folder_path, file_name)
-            locations.append(file_name[:-4])  # Extract location name
-            
-            # Read the CSV file into a DataFrame
-            df = pd.read_csv(file_path, low_memory=False)
-            
-            # Clean data: Replace any number followed by 's' with the number only
-            pattern = r'(\d+)s'
-            df = df.replace(regex={pattern: r'\1'})
-            
-            # Extract month from date column
-            df['MONTH'] = df['DATE'].apply(lambda date: int(date.split('-')[1]))
-            
-            # Initialize a dictionary to store monthly averages for the current CSV file
-            monthly_averages = {field: [] for field in monthly_avg_fields}
-            
-            # Iterate through each field in monthly_avg_fields
-            for field in monthly_avg_fields:
-                # Check if the field exists and contains at least one non-empty value
-                if not df[field].isnull().all():
-                    # Extract the monthly average for each month
-                    for month in range(1, 13):
-                        monthly_avg = df[df['MONTH'] == month][field].astype('float').mean()
-                        monthly_averages[field].append(monthly_avg)
-            
-            # Append the dictionary containing monthly averages for the current CSV file to the list
-            monthly_averages_list.append(monthly_averages)
+    # Extract the monthly values of each station file (LCD .csv or ingested .npz), in sorted file order
+    file_paths = [os.path.join(folder_path, file_name) for file_name in file_names]
+    if partials_dir is None:
+        results = lcd.map_stations(station_monthly_values, file_paths, (monthly_avg_fields, chunksize), workers)
+    else:
+        results = partials.map_stations_memoized(station_monthly_values, file_paths, (monthly_avg_fields, chunksize),
+                                                 partials_dir, workers)
+    
+    for monthly_values, has_values in results:
+        # Store the monthly values of fields which contain at least one non-empty value
+        monthly_averages = {field: list(monthly_values[:, i]) if has_values[i] else []
+                            for i, field in enumerate(monthly_avg_fields)}
+        monthly_averages_list.append(monthly_averages)
     
     return monthly_averages_list, locations
 
-def create_csv_from_dict(data_list, locations):
+def extract_monthly_averages_from_cube(cube_path, monthly_avg_fields):
+    """
+    Computes the monthly averages for specified fields of all stations from the data cube.
+
+    The reduction runs over all stations in one vectorized call. Each day contributes a
+    single value, taken from the float32 cube, so the averages may differ from
+    extract_monthly_averages in the last digits.
+
+    Args:
+        cube_path (str): Path to the cube written by the ingest stage.
+        monthly_avg_fields (list): List of fields for which monthly averages are to be computed.
+
+    Returns:
+        tuple: A tuple containing a list of dictionaries with monthly averages for each field
+        and a list of locations.
+    """
+    data, meta = cube.open_cube(cube_path)
+    values = cube.select_fields(data, meta, monthly_avg_fields)
+    monthly_values = cube.monthly_means(values, meta['year'])
+    has_values = ~np.isnan(values).all(axis=1)
+
+    # Store the monthly values of fields which contain at least one non-empty value
+    monthly_averages_list = [{field: list(monthly_values[station, :, i]) if has_values[station, i] else []
+                              for i, field in enumerate(monthly_avg_fields)}
+                             for station in range(len(meta['stations']))]
+    return monthly_averages_list, meta['stations']
+
+def create_csv_from_dict(data_list, locations, output_file=os.path.join('outputs', 'process_output.csv')):
     """
     Creates a CSV file from a list of dictionaries containing monthly averages.
 
     Args:
         data_list (list): List of dictionaries containing monthly averages for each field.
         locations (list): List of locations (CSV file names without extension).
+        output_file (str, optional): Path of the CSV file to write.
     """
     # Get the field names from the keys of the dictionary
     # Include 'Location' and 'Month' as the first and second fields
     field_names = ['Location', 'Month'] + list(data_list[0].keys())
     
-    # Define the output file path
-    output_file = os.path.join('outputs', 'process_output.csv')
-    
     # Write data to CSV file
     with open(output_file, 'w', newline='') as csvfile:
         writer = csv.DictWriter(csvfile, fieldnames=field_names)
@@ -86,15 +228,38 @@ def create_csv_from_dict(data_list, locations):
                 writer.writerow(row_data)
 
 if __name__ == "__main__":
-    folder_path = 'data'
+    folder_path = 'intermediate'
+
+    # Read the number of worker processes, the chunk size and the profiling switch from the YAML file
+    with open('params/params.yaml', 'r') as file:
+        all_params = yaml.safe_load(file)
+    params = all_params['extract']
+    profile = all_params['metrics']['profile']
+    workers = params['workers']
+    chunksize = params['chunksize']
+    use_cube = params['cube']
+    partials_dir = 'outputs/partials/process'
     all_daily_avg_fields_file = 'outputs/daily_fields_list.txt'
 
     # Read the list from the text file
     with open(all_daily_avg_fields_file, 'r') as text_file:
         all_daily_avg_fields = [line.strip() for line in text_file]
         
-    # Extract monthly averages and locations from CSV files
-    monthly_averages, locations = extract_monthly_averages(folder_path, all_daily_avg_fields)
+    with metrics.stage_metrics('process', profile=profile) as counters:
+        # Extract monthly averages and locations from CSV files
+        if use_cube:
+            monthly_averages, locations = extract_monthly_averages_from_cube(os.path.join(folder_path, 'cube.npy'), all_daily_avg_fields)
+        else:
+            monthly_averages, locations = extract_monthly_averages(folder_path, all_daily_avg_fields, workers, partials_dir, chunksize)
     
-    # Create CSV file from extracted monthly averages
-    create_csv_from_dict(monthly_averages, locations)
\ No newline at end of file
+        # Create CSV file from extracted monthly averages
+        create_csv_from_dict(monthly_averages, locations)
+        # Write the binary table read by the evaluate stage
+        tables.write_table('outputs/process_output.npz', locations, list(monthly_averages[0].keys()),
+                           tables.monthly_table(monthly_averages))
+
+        # Record the stations read and the rows written
+        counters['files'] = len(locations)
+        counters['bytes'] = sum(os.path.getsize(os.path.join(folder_path, file_name))
+                                for file_name in lcd.list_stations(folder_path))
+        counters['rows'] = 12 * len(locations)
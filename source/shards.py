@@ -0,0 +1,212 @@
+import os
+import sys
+import yaml
+import shutil
+import hashlib
+import numpy as np
+import lcd
+import prepare
+import process
+import evaluate
+import metrics
+import tables
+
+def shard_of(station, count):
+    """
+    Assigns a station to one of count shards by the hash of its name.
+
+    The assignment only depends on the station name, so a station stays in the same shard
+    whichever other stations are downloaded.
+
+    Args:
+        station (str): Name of the station.
+        count (int): Number of shards.
+
+    Returns:
+        int: Shard of the station, from 0 to count - 1.
+    """
+    if not isinstance(count, int) or count <= 0:
+        raise ValueError("count must be a positive integer.")
+
+    return int(hashlib.sha256(station.encode()).hexdigest()[:8], 16) % count
+
+def split_stations(folder_path, shards_dir, count):
+    """
+    Copies the station files of a folder into one subfolder per shard.
+
+    Every shard folder also gets a stations.txt listing its stations, so that a shard
+    without stations still exists as a dependency of its stages.
+
+    Args:
+        folder_path (str): Path to the folder containing station files (LCD .csv or ingested .npz).
+        shards_dir (str): Folder to write the shard folders to, replacing its contents.
+        count (int): Number of shards.
+
+    Returns:
+        list of list of str: Station files of each shard.
+    """
+    shutil.rmtree(shards_dir, ignore_errors=True)
+    shard_files = [[] for _ in range(count)]
+    for file_name in lcd.list_stations(folder_path):
+        shard_files[shard_of(os.path.splitext(file_name)[0], count)].append(file_name)
+
+    for shard, file_names in enumerate(shard_files):
+        shard_dir = os.path.join(shards_dir, str(shard))
+        os.makedirs(shard_dir)
+        for file_name in file_names:
+            shutil.copyfile(os.path.join(folder_path, file_name), os.path.join(shard_dir, file_name))
+        with open(os.path.join(shard_dir, 'stations.txt'), 'w') as file:
+            for file_name in file_names:
+                file.write(os.path.splitext(file_name)[0] + '\n')
+    return shard_files
+
+def extract_shard(module, shard_dir, output_file, fields, workers=1, partials_dir=None, chunksize=None):
+    """
+    Runs the monthly extraction of the prepare or process stage on the stations of one shard.
+
+    Args:
+        module (module): prepare or process.
+        shard_dir (str): Folder holding the stations of the shard.
+        output_file (str): Path of the .npz table to write.
+        fields (list of str): Fields to extract.
+        workers (int, optional): Number of worker processes for the stations.
+        partials_dir (str, optional): Directory to memoize per-station results in.
+        chunksize (int, optional): Stream each station file in chunks of this many rows.
+
+    Returns:
+        int: Number of stations in the shard.
+    """
+    monthly_averages, locations = module.extract_monthly_averages(shard_dir, fields, workers, partials_dir, chunksize)
+
+    # A shard may hold no stations at all
+    values = tables.monthly_table(monthly_averages) if monthly_averages else np.empty((0, 12, len(fields)))
+    tables.write_table(output_file, locations, fields, values)
+    return len(locations)
+
+def evaluate_shard(gt_file, est_file, output_file):
+    """
+    Computes the R-squared values of the stations of one shard.
+
+    Args:
+        gt_file (str): Path to the ground truth .npz table of the shard.
+        est_file (str): Path to the estimated .npz table of the shard.
+        output_file (str): Path of the .npz table of R-squared values to write.
+
+    Returns:
+        int: Number of stations in the shard.
+    """
+    _, field_names, monthly_avg_gt = tables.read_table(gt_file)
+    locations, _, monthly_avg_est = tables.read_table(est_file)
+    tables.write_table(output_file, locations, field_names, evaluate.r2_matrix(monthly_avg_gt, monthly_avg_est))
+    return len(locations)
+
+def concat_tables(file_paths):
+    """
+    Concatenates the tables of all shards, ordering the rows by location as the unsharded stages do.
+
+    Args:
+        file_paths (list of str): Paths to the .npz table of each shard.
+
+    Returns:
+        tuple: The locations, the field names and the values of all shards.
+    """
+    shard_tables = [tables.read_table(file_path) for file_path in file_paths]
+    locations = np.concatenate([table[0] for table in shard_tables])
+    values = np.concatenate([table[2] for table in shard_tables])
+    order = np.argsort(locations, kind='stable')
+    return locations[order], shard_tables[0][1], values[order]
+
+def reduce_stage(stage, shards_dir, shard_ids, outputs_dir='outputs'):
+    """
+    Merges the shard tables of a stage into the same .npz and CSV outputs as the unsharded stage writes.
+
+    Args:
+        stage (str): 'prepare', 'process' or 'evaluate'.
+        shards_dir (str): Folder holding the shard tables, as shards_dir/<stage>/<shard>.npz.
+        shard_ids (list of int): Shards to merge.
+        outputs_dir (str, optional): Folder to write the outputs to.
+
+    Returns:
+        int: Number of stations merged.
+    """
+    if stage not in ('prepare', 'process', 'evaluate'):
+        raise ValueError("Unknown stage: {}".format(stage))
+
+    file_paths = [os.path.join(shards_dir, stage, '{}.npz'.format(shard)) for shard in shard_ids]
+    locations, field_names, values = concat_tables(file_paths)
+    tables.write_table(os.path.join(outputs_dir, stage + '_output.npz'), locations, field_names, values)
+
+    csv_file = os.path.join(outputs_dir, stage + '_output.csv')
+    if stage == 'evaluate':
+        evaluate.convert_to_csv(csv_file, values.tolist(), field_names, locations)
+    else:
+        monthly_averages = [{field: list(values[station, :, i]) for i, field in enumerate(field_names)}
+                            for station in range(len(locations))]
+        module = prepare if stage == 'prepare' else process
+        module.create_csv_from_dict(monthly_averages, list(locations), csv_file)
+    return len(locations)
+
+if __name__ == "__main__":
+    # Usage: shards.py split | shards.py <prepare|process|evaluate> <shard> | shards.py reduce <stage>
+    folder_path = 'intermediate'
+    shards_dir = 'shards'
+    all_daily_avg_fields = ['DailyAverageDryBulbTemperature',
+                            'DailyMaximumDryBulbTemperature',
+                            'DailyMinimumDryBulbTemperature',
+                            'DailyAverageSeaLevelPressure',
+                            'DailyAverageStationPressure']
+    all_monthly_avg_fields = ['MonthlyMeanTemperature',
+                              'MonthlyMaximumTemperature',
+                              'MonthlyMinimumTemperature',
+                              'MonthlySeaLevelPressure',
+                              'MonthlyStationPressure']
+    text_file_path = 'outputs/daily_fields_list.txt'
+
+    # Read the shards, the extraction settings and the profiling switch from the YAML file
+    with open('params/params.yaml', 'r') as file:
+        all_params = yaml.safe_load(file)
+    shard_ids = all_params['shard']['ids']
+    if shard_ids != list(range(len(shard_ids))):
+        raise ValueError("shard.ids must be 0, 1, ..., number of shards - 1")
+    params = all_params['extract']
+    profile = all_params['metrics']['profile']
+    command = sys.argv[1]
+
+    if command == 'split':
+        with metrics.stage_metrics('split', profile=profile) as counters:
+            # Write the list of daily fields read by the process shards
+            os.makedirs('outputs', exist_ok=True)
+            with open(text_file_path, 'w') as text_file:
+                for field in all_daily_avg_fields:
+                    text_file.write(field + '\n')
+            shard_files = split_stations(folder_path, os.path.join(shards_dir, 'stations'), len(shard_ids))
+            counters['files'] = sum(len(file_names) for file_names in shard_files)
+            counters['shards'] = len(shard_files)
+    elif command == 'reduce':
+        stage = sys.argv[2]
+        with metrics.stage_metrics(stage, profile=profile) as counters:
+            n_stations = reduce_stage(stage, shards_dir, shard_ids)
+            # Rows written, as recorded by the unsharded scripts
+            counters['rows'] = n_stations if stage == 'evaluate' else 12 * n_stations
+            counters['shards'] = len(shard_ids)
+    else:
+        shard = sys.argv[2]
+        output_dir = os.path.join(shards_dir, command)
+        output_file = os.path.join(output_dir, shard + '.npz')
+        os.makedirs(output_dir, exist_ok=True)
+        with metrics.stage_metrics(command + '_' + shard, os.path.join('metrics', 'shards'), profile) as counters:
+            shard_dir = os.path.join(shards_dir, 'stations', shard)
+            if command == 'prepare':
+                counters['files'] = extract_shard(prepare, shard_dir, output_file, all_monthly_avg_fields,
+                                                  params['workers'], 'outputs/partials/prepare', params['chunksize'])
+            elif command == 'process':
+                # Read the list of daily fields written by the split stage
+                with open(text_file_path, 'r') as text_file:
+                    all_daily_avg_fields = [line.strip() for line in text_file]
+                counters['files'] = extract_shard(process, shard_dir, output_file, all_daily_avg_fields,
+                                                  params['workers'], 'outputs/partials/process', params['chunksize'])
+            elif command == 'evaluate':
+                counters['files'] = evaluate_shard(os.path.join(shards_dir, 'prepare', shard + '.npz'),
+                                                   os.path.join(shards_dir, 'process', shard + '.npz'), output_file)
+            else:
+                raise ValueError("Unknown command: {}".format(command))
@@ -0,0 +1,180 @@
+import os
+import csv
+import yaml
+import copy
+import shutil
+import itertools
+import lcd
+import catalog
+import download
+import ingest
+import pipeline
+
+def variant_name(year, seed, n_locs):
+    """
+    Returns the folder name of a sweep variant.
+
+    Args:
+        year (int): Year of the variant.
+        seed (int): Seed of the variant.
+        n_locs (int): Number of locations of the variant.
+
+    Returns:
+        str: Folder name holding the parameters of the variant.
+    """
+    return 'year={}_seed={}_n_locs={}'.format(year, seed, n_locs)
+
+def expand_grid(years, seeds, n_locs_list):
+    """
+    Expands lists of parameter values into every (year, seed, n_locs) combination.
+
+    Args:
+        years (list of int): Years to sweep.
+        seeds (list of int): Seeds to sweep.
+        n_locs_list (list of int): Numbers of locations to sweep.
+
+    Returns:
+        list of tuple: (year, seed, n_locs) of each variant.
+    """
+    return list(itertools.product(years, seeds, n_locs_list))
+
+def run_variant(variant_dir, daily_avg_fields, monthly_avg_fields, partials_dir, workers=1, chunksize=None):
+    """
+    Runs the prepare, process and evaluate stages of a variant on its ingested stations.
+
+    Args:
+        variant_dir (str): Folder of the variant, holding its intermediate and outputs folders.
+        daily_avg_fields (list of str): Daily fields to average per month.
+        monthly_avg_fields (list of str): Monthly fields to extract.
+        partials_dir (str): Directory of the per-station results shared by all variants.
+        workers (int, optional): Number of worker processes for the stations of the variant.
+        chunksize (int, optional): Stream each station file in chunks of this many rows.
+
+    Returns:
+        tuple: The locations, the field names and the R-squared values of each location.
+    """
+    return pipeline.run_stages(os.path.join(variant_dir, 'intermediate'), os.path.join(variant_dir, 'outputs'),
+                               daily_avg_fields, monthly_avg_fields, partials_dir, workers, chunksize)
+
+def run_sweep(base_url, grid, params, daily_avg_fields, monthly_avg_fields, sweep_dir='sweeps', rates=None):
+    """
+    Runs the whole pipeline for every (year, seed, n_locs) variant of a parameter grid in one process.
+
+    Variants share all caches: station files come from the persistent station cache, each
+    distinct station file is ingested once into a shared store and copied into every
+    variant using it, and per-station monthly results are memoized across variants. Each
+    variant keeps its own data, intermediate and outputs folders plus its full effective
+    params/params.yaml and params/validity_rates.json under sweep_dir, so its results can be
+    reproduced on their own. The candidates of every variant are ordered by the same given
+    rates rather than by the verdicts in the cache, so the stations of a variant do not
+    depend on the variants run before it. The R-squared values of all variants are
+    collected in sweep_dir/results.csv.
+
+    Args:
+        base_url (str): Base URL for downloading files.
+        grid (list of tuple): (year, seed, n_locs) of each variant.
+        params (dict): Contents of params.yaml, the download section of each variant being
+            replaced by its year, seed and n_locs. sweep.workers sets the number of worker
+            processes for ingesting and evaluating variants, extract.workers and extract.chunksize
+            apply to the stations of each variant, which are always extracted per station.
+        daily_avg_fields (list of str): Daily fields to average per month.
+        monthly_avg_fields (list of str): Monthly fields to extract.
+        sweep_dir (str, optional): Folder holding the variants and the results.
+        rates (dict, optional): Validity counts ordering the candidates (see catalog.load_rates),
+            None to keep the seeded order.
+
+    Returns:
+        str: Path of the consolidated results table.
+    """
+    if not isinstance(grid, list) or not grid:
+        raise ValueError("grid must be a non-empty list of (year, seed, n_locs) tuples.")
+
+    fields = daily_avg_fields + monthly_avg_fields + lcd.hourly_fields(daily_avg_fields)
+    download_params = params['download']
+    extract_params = params['extract']
+    workers = params['sweep']['workers']
+    store_dir = os.path.join(sweep_dir, 'store')
+    partials_dir = os.path.join(sweep_dir, 'partials')
+    os.makedirs(store_dir, exist_ok=True)
+
+    # Download the stations of each variant through the shared station cache
+    variants = []  # (params, variant_dir) of the variants with stations
+    for year, seed, n_locs in grid:
+        variant_dir = os.path.join(sweep_dir, variant_name(year, seed, n_locs))
+        for folder in ('data', 'intermediate', 'outputs'):
+            shutil.rmtree(os.path.join(variant_dir, folder), ignore_errors=True)
+        print("Downloading", variant_name(year, seed, n_locs))
+        status = download.download_csv(base_url, year, n_locs, seed, download_params['workers'],
+                                       os.path.join(variant_dir, 'data'), download_params['cache_dir'],
+                                       download_params['timeout'], download_params['retries'],
+                                       download_params['min_size'], download_params['max_size'], rates=rates)
+        # Record the full parameters the variant is computed with, so that it can be reproduced
+        # on its own. The cache is shared, so its path must not depend on the working directory
+        variant_params = copy.deepcopy(params)
+        variant_params['download'].update({'n_locs': n_locs, 'year': year, 'seed': seed,
+                                           'cache_dir': os.path.abspath(download_params['cache_dir'])})
+        variant_params['extract']['cube'] = False
+        os.makedirs(os.path.join(variant_dir, 'params'), exist_ok=True)
+        with open(os.path.join(variant_dir, 'params', 'params.yaml'), 'w') as file:
+            yaml.safe_dump(variant_params, file, sort_keys=False)
+        if rates is not None:
+            catalog.save_rates(rates, os.path.join(variant_dir, 'params', 'validity_rates.json'))
+        if status == 0:
+            print("No valid files found for", variant_name(year, seed, n_locs))
+            continue
+        variants.append(((year, seed, n_locs), variant_dir))
+
+    # Ingest every distinct station file once, as variants of a year share files
+    unique = {}
+    for (year, _, _), variant_dir in variants:
+        data_dir = os.path.join(variant_dir, 'data')
+        for file_name in lcd.list_stations(data_dir):
+            unique.setdefault((year, file_name), os.path.join(data_dir, file_name))
+    store_paths = dict(zip(unique, lcd.map_stations(ingest.ingest_to_store, list(unique.values()),
+                                                    (store_dir, fields, None, extract_params['chunksize']), workers)))
+
+    # Copy the ingested stations into the intermediate folder of each variant
+    for (year, _, _), variant_dir in variants:
+        intermediate_dir = os.path.join(variant_dir, 'intermediate')
+        os.makedirs(intermediate_dir, exist_ok=True)
+        for file_name in lcd.list_stations(os.path.join(variant_dir, 'data')):
+            shutil.copyfile(store_paths[(year, file_name)], os.path.join(intermediate_dir, file_name[:-4] + '.npz'))
+
+    # Evaluate the variants concurrently
+    results = lcd.map_stations(run_variant, [variant_dir for _, variant_dir in variants],
+                               (daily_avg_fields, monthly_avg_fields, partials_dir, extract_params['workers'],
+                                extract_params['chunksize']), workers)
+
+    # Collect the R-squared values of all variants in one table
+    results_file = os.path.join(sweep_dir, 'results.csv')
+    with open(results_file, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['year', 'seed', 'n_locs', 'Location'] + monthly_avg_fields)
+        for ((year, seed, n_locs), _), (locations, _, r2_values) in zip(variants, results):
+            for location, r2_location in zip(locations, r2_values):
+                writer.writerow([year, seed, n_locs, location] + r2_location)
+    return results_file
+
+if __name__ == "__main__":
+    # Define base url
+    base_url = 'https://www.ncei.noaa.gov/data/local-climatological-data/'
+    # Read YAML file
+    with open('params/params.yaml', 'r') as file:
+        data = yaml.safe_load(file)
+
+    # Extract variables
+    grid = expand_grid(data['sweep']['years'], data['sweep']['seeds'], data['sweep']['n_locs'])
+    all_daily_avg_fields = ['DailyAverageDryBulbTemperature', 
+                            'DailyMaximumDryBulbTemperature', 
+                            'DailyMinimumDryBulbTemperature',
+                            'DailyAverageSeaLevelPressure',
+                            'DailyAverageStationPressure']
+    all_monthly_avg_fields = ['MonthlyMeanTemperature', 
+                              'MonthlyMaximumTemperature', 
+                              'MonthlyMinimumTemperature',
+                              'MonthlySeaLevelPressure', 
+                              'MonthlyStationPressure']
+
+    # Run every variant of the grid, ordering the candidates by the tracked validity rates
+    run_sweep(base_url, grid, data, all_daily_avg_fields, all_monthly_avg_fields, 'sweeps',
+              catalog.load_rates('params/validity_rates.json'))
@@ -0,0 +1,52 @@
+import numpy as np
+
+def monthly_table(data_list):
+    """
+    Stacks the monthly averages produced by the prepare and process stages into a single float array.
+
+    The array equals what evaluate.read_monthly_table returns for the CSV file written from the same data.
+
+    Args:
+        data_list (list of dict): For each location, the 12 monthly values of each field, or an
+            empty list for fields without values.
+
+    Returns:
+        numpy.ndarray: A (locations x 12 x fields) float array of the monthly values.
+    """
+    if not isinstance(data_list, list) or not data_list:
+        raise ValueError("data_list must be a non-empty list")
+
+    rows = [[values if len(values) else [np.nan] * 12 for values in data_dict.values()] for data_dict in data_list]
+    return np.array(rows, dtype=np.float64).transpose(0, 2, 1)
+
+def write_table(file_path, locations, field_names, values):
+    """
+    Writes a table of float values per location (and month) to a binary .npz file.
+
+    Values are stored as float64 arrays, so reading the file back gives exactly the same
+    numbers without any text parsing.
+
+    Args:
+        file_path (str): Path of the .npz file to write.
+        locations (list of str): Location of each row of values.
+        field_names (list of str): Field of each column of values.
+        values (numpy.ndarray): (locations x 12 x fields) monthly values or (locations x fields) values.
+    """
+    if len(locations) != len(values) or len(field_names) != values.shape[-1]:
+        raise ValueError("values must have one row per location and one column per field")
+
+    np.savez(file_path, locations=np.array(locations, dtype=str), fields=np.array(field_names, dtype=str),
+             values=np.asarray(values, dtype=np.float64))
+
+def read_table(file_path):
+    """
+    Reads a table written by write_table.
+
+    Args:
+        file_path (str): Path to the .npz file.
+
+    Returns:
+        tuple: An array of the locations, a list of field names and the float array of the values.
+    """
+    with np.load(file_path) as table:
+        return table['locations'], table['fields'].tolist(), table['values']
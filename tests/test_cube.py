@@ -0,0 +1,57 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..', 'source'))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..', 'benchmarks'))
+
+import lcd
+import cube
+import ingest
+import process
+import synthetic
+
+DAILY_FIELDS = ['DailyAverageDryBulbTemperature',
+                'DailyMaximumDryBulbTemperature',
+                'DailyMinimumDryBulbTemperature',
+                'DailyAverageSeaLevelPressure',
+                'DailyAverageStationPressure']
+MONTHLY_FIELDS = ['MonthlyMeanTemperature',
+                  'MonthlyMaximumTemperature',
+                  'MonthlyMinimumTemperature',
+                  'MonthlySeaLevelPressure',
+                  'MonthlyStationPressure']
+
+@pytest.fixture(scope='module')
+def intermediate(tmp_path_factory):
+    """
+    Ingests a station with daily summaries and a station which only reports hourly data.
+    """
+    root = tmp_path_factory.mktemp('cube')
+    data_dir, intermediate_dir = str(root / 'data'), str(root / 'intermediate')
+    os.makedirs(data_dir)
+    synthetic.write_station(os.path.join(data_dir, '72000000001.csv'), '72000000001', 2023, seed=1, hours_per_day=4)
+    synthetic.write_station(os.path.join(data_dir, '72000000002.csv'), '72000000002', 2023, seed=2, hours_per_day=4,
+                            has_daily=False)
+    ingest.ingest_folder(data_dir, intermediate_dir, DAILY_FIELDS + MONTHLY_FIELDS + lcd.hourly_fields(DAILY_FIELDS))
+    return intermediate_dir
+
+@pytest.mark.parametrize('chunksize', [None, 50])
+def test_cube_matches_stations(intermediate, tmp_path, chunksize):
+    file_paths = [os.path.join(intermediate, file_name) for file_name in lcd.list_stations(intermediate)]
+    cube_path = str(tmp_path / 'cube.npy')
+    cube.build_cube(file_paths, cube_path, DAILY_FIELDS + MONTHLY_FIELDS, 2023, chunksize=chunksize)
+
+    from_cube, cube_locations = process.extract_monthly_averages_from_cube(cube_path, DAILY_FIELDS)
+    from_stations, locations = process.extract_monthly_averages(intermediate, DAILY_FIELDS)
+    assert list(cube_locations) == list(locations)
+    for cube_averages, averages in zip(from_cube, from_stations):
+        for field in DAILY_FIELDS:
+            assert len(cube_averages[field]) == len(averages[field])
+            assert np.allclose(cube_averages[field], averages[field], rtol=1e-6, equal_nan=True)
+
+    # The station without daily summaries gets its monthly means from the hourly observations
+    assert all(len(from_cube[1][field]) == 12 for field in DAILY_FIELDS)
+    assert not np.isnan(from_cube[1]['DailyAverageDryBulbTemperature']).all()
@@ -0,0 +1,72 @@
+import os
+import sys
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..', 'source'))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..', 'benchmarks'))
+
+import download
+import synthetic
+
+@pytest.fixture(scope='module')
+def server(tmp_path_factory):
+    """
+    Serves 40 small synthetic stations of 2022 and of 2023, about half of them valid.
+    """
+    root = str(tmp_path_factory.mktemp('root'))
+    synthetic.generate_stations(root, 40, 2022, seed=2, hours_per_day=2)
+    synthetic.generate_stations(root, 40, 2023, seed=3, hours_per_day=2)
+    server, base_url = synthetic.serve(root)
+    yield base_url
+    server.shutdown()
+    server.server_close()
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_warm_rerun_fetches_nothing(server, tmp_path, workers):
+    cache_dir = str(tmp_path / 'cache')
+    cold, warm = {}, {}
+    assert download.download_csv(server, 2023, 3, 1, workers, str(tmp_path / 'cold'), cache_dir, counters=cold) == 1
+    assert download.download_csv(server, 2023, 3, 1, workers, str(tmp_path / 'warm'), cache_dir, counters=warm) == 1
+
+    # The selection is restored from the cache without any transfer
+    assert sorted(os.listdir(tmp_path / 'warm')) == sorted(os.listdir(tmp_path / 'cold'))
+    assert cold['bytes_fetched'] > 0
+    assert warm['bytes_fetched'] == 0
+    assert warm['candidates_tried'] == 0
+    assert warm['candidates_cached'] == 3
+
+def test_selection_ignores_other_years(server, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    download.download_csv(server, 2023, 3, 1, 4, str(tmp_path / 'before'), cache_dir)
+    # Verdicts of another year in the same cache do not reorder the candidates
+    download.download_csv(server, 2022, 10, 1, 4, str(tmp_path / 'other'), cache_dir)
+    download.download_csv(server, 2023, 3, 1, 4, str(tmp_path / 'after'), cache_dir)
+    assert sorted(os.listdir(tmp_path / 'after')) == sorted(os.listdir(tmp_path / 'before'))
+
+def test_changed_station_is_rechecked(tmp_path):
+    root = str(tmp_path / 'root')
+    synthetic.generate_stations(root, 20, 2023, seed=4, hours_per_day=2)
+    server, base_url = synthetic.serve(root)
+    try:
+        cache_dir = str(tmp_path / 'cache')
+        download.download_csv(base_url, 2023, 3, 1, 4, str(tmp_path / 'before'), cache_dir)
+        changed = sorted(os.listdir(tmp_path / 'before'))[0]
+
+        # Replace a selected station by an invalid version, listed with a later modification time
+        folder = os.path.join(root, 'access', '2023')
+        station_path = os.path.join(folder, changed)
+        mtime = os.path.getmtime(station_path) + 120
+        synthetic.write_station(station_path, changed[:-4], 2023, seed=5, hours_per_day=2, has_daily=False,
+                                has_monthly=False)
+        os.utime(station_path, (mtime, mtime))
+        os.utime(folder, (mtime, mtime))
+
+        counters = {}
+        download.download_csv(base_url, 2023, 3, 1, 4, str(tmp_path / 'after'), cache_dir, counters=counters)
+    finally:
+        server.shutdown()
+        server.server_close()
+    # The cached verdict of the old version is not reused, the new version is fetched and ruled out
+    assert changed not in os.listdir(tmp_path / 'after')
+    assert counters['candidates_tried'] >= 1
@@ -0,0 +1,203 @@
+import os
+import sys
+import json
+import hashlib
+import functools
+import threading
+import http.server
+import email.utils
+import pytest
+import requests
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..', 'source'))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..', 'benchmarks'))
+
+import fetch
+import synthetic
+
+# Size of the served file, spanning several chunks of iter_fetch
+FILE_SIZE = 300000
+# Bytes sent by a broken transfer before the connection is dropped, more than one chunk
+BROKEN_SIZE = 100000
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Serves files without Range support, always answering 200 with the whole file.
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+class FlakyHandler(synthetic.StandInHandler):
+    """
+    Serves files with Range support, breaking off the first failures transfers after BROKEN_SIZE bytes.
+    """
+
+    failures = 1
+    ranges = []
+
+    def copyfile(self, source, outputfile):
+        FlakyHandler.ranges.append(self.headers.get('Range'))
+        if FlakyHandler.failures > 0:
+            FlakyHandler.failures -= 1
+            # Send part of the announced body, then drop the connection
+            outputfile.write(source.read(BROKEN_SIZE))
+            self.close_connection = True
+            return
+        super().copyfile(source, outputfile)
+
+def start_server(root, handler):
+    """
+    Starts a server for the files of root in a background thread.
+
+    Args:
+        root (str): Folder to serve.
+        handler (type): Request handler class.
+
+    Returns:
+        tuple: The server, to be stopped with shutdown(), and its base URL.
+    """
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(handler, directory=root))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}/'.format(server.server_address[1])
+
+@pytest.fixture
+def served(tmp_path):
+    """
+    Writes the file to serve and returns its contents, the served folder and the download path.
+    """
+    root = tmp_path / 'root'
+    root.mkdir()
+    contents = os.urandom(FILE_SIZE)
+    (root / 'station.csv').write_bytes(contents)
+    return contents, str(root), str(tmp_path / 'station.csv')
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    """
+    Records the backoff delays of iter_fetch instead of sleeping.
+    """
+    delays = []
+    monkeypatch.setattr(fetch.time, 'sleep', delays.append)
+    return delays
+
+def write_part(file_path, data, served_path):
+    """
+    Leaves a partial file as an interrupted transfer of served_path would, with its validator.
+    """
+    with open(file_path + '.part', 'wb') as part:
+        part.write(data)
+    with open(file_path + '.part.json', 'w') as file:
+        json.dump({'validator': email.utils.formatdate(os.stat(served_path).st_mtime, usegmt=True)}, file)
+
+def fetch_with(root, handler, file_path, **kwargs):
+    """
+    Fetches station.csv from a server for root, returning the chunks and the stats.
+    """
+    server, base_url = (synthetic.serve(root) if handler is None else start_server(root, handler))
+    try:
+        stats = {}
+        with requests.Session() as session:
+            chunks = list(fetch.iter_fetch(session, base_url + 'station.csv', file_path, stats, timeout=10, **kwargs))
+        return chunks, stats
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def check_complete(contents, file_path, chunks, stats):
+    """
+    Checks that the chunks and the written file cover the whole file.
+    """
+    assert b''.join(chunks) == contents
+    with open(file_path, 'rb') as file:
+        assert file.read() == contents
+    assert not os.path.exists(file_path + '.part')
+    assert not os.path.exists(file_path + '.part.json')
+    assert stats['size'] == len(contents)
+    assert stats['sha256'] == hashlib.sha256(contents).hexdigest()
+
+def test_fetch_whole_file(served):
+    contents, root, file_path = served
+    chunks, stats = fetch_with(root, None, file_path)
+    check_complete(contents, file_path, chunks, stats)
+    assert stats['bytes_fetched'] == len(contents)
+
+def test_resume_with_range(served):
+    contents, root, file_path = served
+    write_part(file_path, contents[:100000], os.path.join(root, 'station.csv'))
+    chunks, stats = fetch_with(root, None, file_path)
+    check_complete(contents, file_path, chunks, stats)
+    # Only the missing tail goes over the network
+    assert stats['bytes_fetched'] == len(contents) - 100000
+
+def test_complete_partial_file(served):
+    contents, root, file_path = served
+    write_part(file_path, contents, os.path.join(root, 'station.csv'))
+    chunks, stats = fetch_with(root, None, file_path)
+    # The server answers 416 and nothing is transferred
+    check_complete(contents, file_path, chunks, stats)
+    assert stats['bytes_fetched'] == 0
+
+def test_server_ignoring_range(served):
+    contents, root, file_path = served
+    write_part(file_path, contents[:100000], os.path.join(root, 'station.csv'))
+    chunks, stats = fetch_with(root, QuietHandler, file_path)
+    # The whole file is transferred again and the bytes already on disk are skipped
+    check_complete(contents, file_path, chunks, stats)
+    assert stats['bytes_fetched'] == len(contents)
+
+def test_partial_file_without_validator(served):
+    contents, root, file_path = served
+    with open(file_path + '.part', 'wb') as part:
+        part.write(b'x' * 100000)
+    chunks, stats = fetch_with(root, None, file_path)
+    # A partial file which cannot be checked against the server is fetched again
+    check_complete(contents, file_path, chunks, stats)
+    assert stats['bytes_fetched'] == len(contents)
+
+def test_resume_changed_upstream(served):
+    contents, root, file_path = served
+    served_path = os.path.join(root, 'station.csv')
+    write_part(file_path, contents[:100000], served_path)
+    # Republish the file with other contents and a later modification time
+    changed = os.urandom(FILE_SIZE)
+    with open(served_path, 'wb') as file:
+        file.write(changed)
+    mtime = os.stat(served_path).st_mtime + 10
+    os.utime(served_path, (mtime, mtime))
+    chunks, stats = fetch_with(root, None, file_path)
+    # The If-Range validator no longer matches, so the whole new file is sent and the partial file dropped
+    check_complete(changed, file_path, chunks, stats)
+    assert stats['bytes_fetched'] == len(changed)
+
+def test_complete_with_mismatched_total(served):
+    contents, root, file_path = served
+    write_part(file_path, contents + b'stale', os.path.join(root, 'station.csv'))
+    chunks, stats = fetch_with(root, None, file_path)
+    # The 416 total is smaller than the partial file, which is fetched again instead of being accepted
+    check_complete(contents, file_path, chunks, stats)
+    assert stats['bytes_fetched'] == len(contents)
+
+def test_retry_interrupted_transfer(served, no_sleep, monkeypatch):
+    contents, root, file_path = served
+    monkeypatch.setattr(FlakyHandler, 'failures', 2)
+    monkeypatch.setattr(FlakyHandler, 'ranges', [])
+    chunks, stats = fetch_with(root, FlakyHandler, file_path, retries=3, backoff=0.5)
+    check_complete(contents, file_path, chunks, stats)
+    # Each retry resumes after the bytes received so far, with exponential backoff
+    assert no_sleep == [0.5, 1.0]
+    starts = [int(header.split('=')[1].rstrip('-')) for header in FlakyHandler.ranges[1:]]
+    assert FlakyHandler.ranges[0] is None and len(starts) == 2 and 0 < starts[0] < starts[1]
+    assert stats['bytes_fetched'] == len(contents)
+
+def test_retries_exhausted(served, no_sleep, monkeypatch):
+    contents, root, file_path = served
+    monkeypatch.setattr(FlakyHandler, 'failures', 3)
+    monkeypatch.setattr(FlakyHandler, 'ranges', [])
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        fetch_with(root, FlakyHandler, file_path, retries=1, backoff=0.5)
+    assert no_sleep == [0.5]
+    # The partial file is kept for a later resume
+    assert not os.path.exists(file_path)
+    assert os.path.getsize(file_path + '.part') > 0